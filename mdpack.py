@@ -5,6 +5,30 @@ import os
 import subprocess
 import shutil
 import logging
+import threading
+import time
+import hashlib
+import json
+import fcntl
+import stat
+import collections
+import contextlib
+import tarfile
+import zipfile
+import math
+import io
+import asyncio
+import signal
+import gzip
+import lzma
+import re
+import tempfile
+import xml.sax.saxutils
+import sqlite3
+import statistics
+import urllib.request
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import Pack
 import yaml  # pip install pyyaml
 from cerberus import Validator  # pip cerberus pyyaml
@@ -49,6 +73,233 @@ class LocalDirectory:
         return self.path
 
 
+class SafeTar:
+    "Extract tar archives inside their destination, with the 'data' filter or the same checks by hand before 3.11.4"
+    filtered = hasattr(tarfile, 'data_filter')
+
+    @staticmethod
+    def inside(dest, path):
+        "path resolved through the symlinks already extracted is in dest, which is resolved"
+        return os.path.commonpath([dest, os.path.realpath(path)]) == dest
+
+    @staticmethod
+    def checked(tar, dest_dir):
+        """The members of tar, raising TarError on one that would land or link outside of dest_dir
+
+        Like the 'data' filter, the paths are resolved on disk as the members are extracted, so that a chain of
+        symlinks can't lead out of dest_dir.
+        """
+        dest = os.path.realpath(dest_dir)
+        for member in tar:
+            path = os.path.join(dest, member.name)
+            if os.path.isabs(member.name) or not SafeTar.inside(dest, path):
+                raise tarfile.TarError(f'{member.name} is outside the destination')
+            if member.issym() or member.islnk():
+                target = os.path.join(os.path.dirname(path) if member.issym() else dest, member.linkname)
+                if os.path.isabs(member.linkname) or not SafeTar.inside(dest, target):
+                    raise tarfile.TarError(f'{member.name} links outside the destination')
+            if member.isdev():
+                raise tarfile.TarError(f'{member.name} is a device file')
+            yield member
+
+    @staticmethod
+    def extractall(tar, dest_dir):
+        if SafeTar.filtered:
+            tar.extractall(dest_dir, filter='data')
+        else:
+            tar.extractall(dest_dir, members=SafeTar.checked(tar, dest_dir))
+
+
+class RotatingLog:
+    "Log file rotated to <path>.1 ... <path>.<backups> when it exceeds max_size, written from several threads"
+    max_size = 100 * 1024 ** 2
+    backups = 3
+
+    def __init__(self, path, watchers=()):
+        self.path = path
+        # called with every data written, like mdpack serve streaming the log to its clients
+        self.watchers = watchers
+        self.lock = threading.Lock()
+        for index in range(1, RotatingLog.backups + 1):
+            if os.path.exists(f'{path}.{index}'):
+                os.remove(f'{path}.{index}')
+        self.file = open(path, mode='wb')
+        self.size = 0
+
+    def write(self, data):
+        with self.lock:
+            if self.size + len(data) > RotatingLog.max_size and self.size > 0:
+                self.rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+        for watcher in self.watchers:
+            watcher(data)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(RotatingLog.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{index}'):
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+        os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, mode='wb')
+        self.size = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class JobLog(logging.Handler):
+    "Route the log records and the commands output of a worker thread to the log file of the job it is running"
+    current = threading.local()
+
+    def emit(self, record):
+        job = getattr(JobLog.current, 'job', None)
+        if job is not None and job.log is not None:
+            job.log.write((self.format(record) + '\n').encode('utf-8'))
+
+    @staticmethod
+    def begin(job, log_dir):
+        LocalDirectory(log_dir, clear_if_exist=False)
+        job.log_path = os.path.realpath(log_dir + '/' + job.name + '.log')
+        job.log = RotatingLog(job.log_path, job.watchers)
+        JobLog.current.job = job
+
+    @staticmethod
+    def end(job):
+        JobLog.current.job = None
+        if job.log is not None:
+            job.log.close()
+            job.log = None
+
+
+class JobFormatter(logging.Formatter):
+    "Prefix console messages with the job name when several jobs run at once"
+    prefix = False
+
+    def format(self, record):
+        text = super().format(record)
+        job = getattr(JobLog.current, 'job', None)
+        if JobFormatter.prefix and job is not None:
+            return f'[{job.name}] ' + text
+        return text
+
+
+class CommandOutput:
+    "Output of a command copied to the job log as it comes, its last lines kept to report a failure"
+
+    def __init__(self, command):
+        # the output may be fed from another thread than the job one
+        self.job = getattr(JobLog.current, 'job', None)
+        self.prefix = f'[{self.job.name}] ' if JobFormatter.prefix and self.job is not None else ''
+        self.tail = collections.deque(maxlen=Packager.tail_lines)
+        self.command = command
+        self.partial = b''
+        self.log(('$ ' + command + '\n').encode('utf-8'))
+
+    def log(self, data):
+        if self.job is not None and self.job.log is not None:
+            self.job.log.write(data)
+
+    def line(self, line):
+        self.log(line)
+        self.tail.append(line)
+        if Packager.live:
+            with Packager.live_lock:
+                sys.stdout.write(self.prefix + line.decode('utf-8', errors='replace'))
+                sys.stdout.flush()
+
+    def feed(self, data):
+        "output received in chunks, written line by line"
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line + b'\n')
+
+    def close(self):
+        if self.partial:
+            self.line(self.partial + b'\n')
+            self.partial = b''
+
+    def failed(self, status):
+        self.close()
+        logging.critical(f'command failed with status {status}: {self.command}')
+        logging.critical(b''.join(self.tail).decode('utf-8', errors='replace').rstrip())
+        return False
+
+
+class Tracer:
+    "Timed spans of the stages of every job, exported in Chrome trace-event format"
+    spans = list()
+    lock = threading.Lock()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            Tracer.add(name, start, time.time(), **args)
+
+    @staticmethod
+    def add(name, start, end, job=None, **args):
+        job = job or getattr(JobLog.current, 'job', None)
+        if job is not None:
+            args.update({'manifest': job.path, 'distro': job.distro, 'version': job.version})
+        with Tracer.lock:
+            Tracer.spans.append({'name': name, 'start': start, 'end': end,
+                                 'job': job.name if job is not None else 'mdpack', 'args': args})
+
+    @staticmethod
+    def add_container_timings(path):
+        "spans of the stages run in a container, written as '<stage> <start> <end> <status>' lines"
+        try:
+            with open(path) as file:
+                lines = file.read().split('\n')
+        except OSError:
+            return
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 4:
+                Tracer.add('container/' + fields[0], float(fields[1]), float(fields[2]), status=int(fields[3]))
+
+    @staticmethod
+    def export(path):
+        "write the spans as Chrome trace events, one thread per job"
+        with Tracer.lock:
+            spans = list(Tracer.spans)
+        origin = min((span['start'] for span in spans), default=0)
+        threads = dict()
+        events = list()
+        for span in spans:
+            tid = threads.setdefault(span['job'], len(threads))
+            events.append({'name': span['name'], 'cat': 'mdpack', 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': round((span['start'] - origin) * 1e6),
+                           'dur': round((span['end'] - span['start']) * 1e6), 'args': span['args']})
+        for job, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': job}})
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+    @staticmethod
+    def summary():
+        "log the count, total, mean and max durations of every stage"
+        stages = dict()
+        with Tracer.lock:
+            for span in Tracer.spans:
+                stages.setdefault(span['name'], []).append(span['end'] - span['start'])
+        rows = [('stage', 'count', 'total', 'mean', 'max')]
+        for name, durations in stages.items():
+            rows.append((name, str(len(durations)), f'{sum(durations):.2f}s',
+                         f'{sum(durations) / len(durations):.2f}s', f'{max(durations):.2f}s'))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        logging.info('')
+        for row in rows:
+            logging.info('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
 class AddingYaml():
     def __init__(self, yaml_path):
         self.dict = dict()
@@ -82,44 +333,64 @@ class Manifest:
             else:
                 setattr(self, key, Manifest(val) if isinstance(val, dict) else val)
 
-    @staticmethod
-    def check_required_fields(in_dict):
-        schema = {
-            'distro': {
-                'required': True,
-                'type': 'list',
-                'schema': {'type': 'string'}
-            },
-            'app': {
-                'required': True,
-                'type': 'dict',
-                'schema': {
-                    'source': {
-                        'required': True,
-                        'type': 'dict',
-                        'schema': {'type': {'required': True, 'type': 'string'}}
-                    },
-                    'build': {
-                        'required': True,
-                        'type': 'dict',
-                        'schema': {'type': {'required': True, 'type': 'string'}}
+    schema = {
+        'distro': {
+            'required': True,
+            'type': 'list',
+            'schema': {'type': 'string'}
+        },
+        'app': {
+            'required': True,
+            'type': 'dict',
+            'schema': {
+                'source': {
+                    'required': True,
+                    'type': 'dict',
+                    'schema': {'type': {'required': True, 'type': 'string'}}
+                },
+                'build': {
+                    'required': True,
+                    'type': 'dict',
+                    'schema': {
+                        'type': {'required': True, 'type': 'string'},
+                        'jobs': {'type': 'integer', 'min': 0},
+                        'generator': {'type': 'string', 'allowed': ['make', 'ninja']}
                     }
                 }
-            },
-            'pkg': {
-                'required': True,
-                'type': 'dict',
-                'schema': {
-                    'package': {'required': True, 'type': 'string'},
-                    'version': {'required': True, 'type': 'string'}
-                }
+            }
+        },
+        'pkg': {
+            'required': True,
+            'type': 'dict',
+            'schema': {
+                'package': {'required': True, 'type': 'string'},
+                'version': {'required': True, 'type': 'string'}
             }
         }
-        val = Validator(schema, allow_unknown=True)
-        if not val.validate(in_dict, schema):
-            logging.critical('Manifest validation error')
-            logging.critical(val.errors)
-            return False
+    }
+    # the schema is compiled once, a validator keeps the state of its last validation
+    validator = Validator(schema, allow_unknown=True)
+    validator_lock = threading.Lock()
+
+    @staticmethod
+    def project(in_dict, schema):
+        "the part of in_dict described by the schema, unknown fields are allowed so they don't need validating"
+        projected = dict()
+        for key, rules in schema.items():
+            if key in in_dict:
+                val = in_dict[key]
+                if rules.get('type') == 'dict' and isinstance(val, dict):
+                    val = Manifest.project(val, rules['schema'])
+                projected[key] = val
+        return projected
+
+    @staticmethod
+    def check_required_fields(in_dict):
+        with Manifest.validator_lock:
+            if not Manifest.validator.validate(Manifest.project(in_dict, Manifest.schema)):
+                logging.critical('Manifest validation error')
+                logging.critical(Manifest.validator.errors)
+                return False
         return True
 
     @staticmethod
@@ -156,6 +427,130 @@ class Manifest:
                 in_dict[key] = in_dict[d + key]
 
 
+class ManifestResolver:
+    """Resolve the manifests of the targets, parsing every manifest and distro defaults file once
+
+    The manifest completed by the distro defaults and the index of its `<distro>_` prefixed keys are cached per
+    (manifest, distro), so that every version is then resolved in a single pass giving the same result as
+    Manifest.add_defaults followed by Manifest.substitute_defaults.
+    """
+
+    # same as yaml.full_load, with libyaml when available
+    loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+    def __init__(self):
+        self.files = dict()
+        self.merged = dict()
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        "the parsed yaml file, None if it can't be read"
+        try:
+            real_path = os.path.realpath(path)
+            mtime = os.stat(real_path).st_mtime_ns
+        except OSError:
+            logging.critical(f'Error opening manifest "{path}", does this file exist?')
+            return None
+        with self.lock:
+            cached = self.files.get(real_path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        try:
+            with open(real_path) as file:
+                data = yaml.load(file, Loader=ManifestResolver.loader)
+        except (OSError, yaml.YAMLError):
+            logging.critical(f'Error opening manifest "{path}", does this file exist?')
+            return None
+        if not isinstance(data, dict):
+            data = dict()
+        with self.lock:
+            self.files[real_path] = (mtime, data)
+        return data
+
+    def targets(self, path):
+        "the (distro, version) couples of a manifest"
+        data = self.load(path)
+        if not data:
+            return []
+        if not isinstance(data.get('distro'), list):
+            logging.critical(f'Manifest validation error, "distro" list is missing in {path}')
+            return []
+        targets = list()
+        for distro_version in data['distro']:
+            distro, version = Packager.get_distro_version(str(distro_version))
+            if distro:
+                targets.append((distro, version))
+        return targets
+
+    @staticmethod
+    def merge(a, b):
+        "a completed by the missing keys of b, like AddingYaml.complete but without modifying a"
+        merged = dict(a)
+        for key, val in b.items():
+            if key not in merged:
+                merged[key] = val
+            elif isinstance(merged[key], dict) and isinstance(val, dict):
+                merged[key] = ManifestResolver.merge(merged[key], val)
+        return merged
+
+    @staticmethod
+    def index(node):
+        "the leaf keys of every dict of node, grouped by the distro they're prefixed with"
+        prefixed = dict()
+        children = dict()
+        for key, val in node.items():
+            if isinstance(val, dict):
+                children[key] = ManifestResolver.index(val)
+            elif isinstance(key, str) and '_' in key:
+                distro, rest = key.split('_', 1)
+                prefixed.setdefault(distro, []).append((key, rest))
+        return prefixed, children
+
+    @staticmethod
+    def resolve_node(node, index, distro, version):
+        prefixed, children = index
+        resolved = dict()
+        for key, val in node.items():
+            resolved[key] = ManifestResolver.resolve_node(val, children[key], distro, version) \
+                if isinstance(val, dict) else val
+
+        # distro_key -> key and distro_version_key -> key
+        d_keys = dict()
+        dv_keys = dict()
+        for key, rest in prefixed.get(distro, ()):
+            d_keys[rest] = key
+            if rest.startswith(version + '_'):
+                dv_keys[rest[len(version) + 1:]] = key
+            kern = rest[len(version) + 1:] if rest.startswith(version + '_') else rest
+            if kern not in node:
+                resolved[kern] = ''
+
+        for kern in set(d_keys) | set(dv_keys):
+            if kern not in resolved or isinstance(resolved[kern], dict):
+                continue
+            if kern in dv_keys and node[dv_keys[kern]] is not None:
+                resolved[kern] = node[dv_keys[kern]]
+            elif kern in d_keys and node[d_keys[kern]] is not None:
+                resolved[kern] = node[d_keys[kern]]
+        return resolved
+
+    def resolve(self, path, distro, version):
+        "the manifest dictionary of path for distro:version, None if it can't be read"
+        key = (os.path.realpath(path), distro)
+        data = self.load(path)
+        if data is None:
+            return None
+        defaults = self.load('mdpack/distro/' + distro + '/' + distro + '.yaml') or dict()
+        with self.lock:
+            cached = self.merged.get(key)
+        if cached is None or cached[0] is not data or cached[1] is not defaults:
+            merged = ManifestResolver.merge(data, defaults)
+            cached = (data, defaults, merged, ManifestResolver.index(merged))
+            with self.lock:
+                self.merged[key] = cached
+        return ManifestResolver.resolve_node(cached[2], cached[3], distro, version)
+
+
 class PkgConfBuilder:
     def __init__(self, manifest, dest_dir):
         match (manifest.pkg.type):
@@ -179,7 +574,9 @@ class PkgConfBuilder:
             self.write(conf, 'Version: ', manifest.pkg, 'version')
             self.write(conf, 'Architecture: ', manifest.pkg, 'arch')
             if hasattr(manifest.pkg, 'summary') and hasattr(manifest.pkg, 'description'):
-                conf.write('Description: ' + str(manifest.pkg.summary) + '\n ' + str(manifest.pkg.description))
+                # the long description is made of continuation lines, ' .' standing for an empty line
+                lines = [' ' + (line.rstrip() or '.') for line in str(manifest.pkg.description).splitlines()]
+                conf.write('Description: ' + str(manifest.pkg.summary) + '\n' + ''.join(line + '\n' for line in lines))
             self.write(conf, 'Maintainer: ', manifest.pkg, 'maintainer')
             self.write(conf, 'Section: ', manifest.pkg, 'section')
             self.write(conf, 'Priority: ', manifest.pkg, 'priority')
@@ -205,17 +602,2068 @@ class PkgConfBuilder:
             conf.write('%prep\n')
             conf.write('%build\n')
             conf.write('%install\ncp -rf /app/install/. %{buildroot}/\n')
-            # automatic list of files in /app/install
-            # excluding already existing files and directories
-            conf.write("find /app/install -name '*' | sed 's/\/app\/install//g' | tail -n +2")
-            conf.write(
-                " | bash -c 'while read file ; do [ ! -f ${file} -a ! -d ${file} ] "
-                "&& echo \"${file}\"; done' > /app/rpmbuild/files_list\n")
+            # the list of files is generated on the host after the build, see files_list()
             conf.write('%files -f /app/rpmbuild/files_list\n')
             conf.close()
 
+    @staticmethod
+    def files_list(dest_dir, base_paths):
+        "write rpmbuild/files_list from one walk of install/, excluding the paths already in the build image"
+        lines = list()
+
+        def entry(path, directory):
+            path = path.replace('%', '%%')
+            if any(c.isspace() for c in path):
+                path = '"' + path + '"'
+            # a directory listed without %dir would own all its content, which is listed anyway
+            lines.append(('%dir ' if directory else '') + path)
+
+        def walk(root, prefix):
+            with os.scandir(root) as entries:
+                for item in entries:
+                    path = prefix + '/' + item.name
+                    directory = item.is_dir(follow_symlinks=False)
+                    if path not in base_paths:
+                        entry(path, directory)
+                    if directory:
+                        walk(item.path, path)
+
+        if os.path.isdir(dest_dir + '/install'):
+            walk(dest_dir + '/install', '')
+        with open(dest_dir + '/rpmbuild/files_list', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        return len(lines)
+
+
+class DebWriter:
+    "Write a .deb on the host from install/, compressing control.tar and data.tar with multithreaded xz or zstd"
+    compression = 'xz'
+    # compressor default level if None
+    level = None
+    package_syntax = r'[a-z0-9][a-z0-9+.-]+'
+    # [epoch:]upstream_version[-debian_revision], the upstream version starting with a digit and holding a colon
+    # only after an epoch
+    version_syntax = r'(\d+:\d[A-Za-z0-9.+~:-]*|\d[A-Za-z0-9.+~-]*)(?<!-)'
+
+    @staticmethod
+    def ar_header(name, size, mtime):
+        return f'{name:<16}{mtime:<12}{0:<6}{0:<6}{100644:<8}{size:<10}`\n'.encode()
+
+    @staticmethod
+    def add_tree(tar, root, skip=None):
+        "add root as './' then its content in name order and the symlinks last, like dpkg-deb --root-owner-group"
+        def add(path, arcname):
+            info = tar.gettarinfo(path, arcname)
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            if info.isreg():
+                with open(path, 'rb') as file:
+                    tar.addfile(info, file)
+            else:
+                tar.addfile(info)
+            return info
+
+        symlinks = list()
+
+        def walk(path, prefix):
+            with os.scandir(path) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    if prefix == './' and entry.name == skip:
+                        continue
+                    if entry.is_symlink():
+                        symlinks.append((entry.path, prefix + entry.name))
+                    elif add(entry.path, prefix + entry.name).isdir():
+                        walk(entry.path, prefix + entry.name + '/')
+
+        add(root, './')
+        walk(root, './')
+        for path, arcname in symlinks:
+            add(path, arcname)
+
+    @staticmethod
+    def member(deb, name, mtime, fill):
+        "append the ar member name to deb, its content streamed by fill(stdin) into the compressor"
+        command = [DebWriter.compression, '-T0', '-c']
+        if DebWriter.level is not None:
+            command.append(f'-{DebWriter.level}')
+        header = deb.tell()
+        deb.write(DebWriter.ar_header(name, 0, mtime))
+        deb.flush()
+        # the compressor writes straight into the package, the member size is known once it's done
+        compressor = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=deb)
+        try:
+            fill(compressor.stdin)
+        finally:
+            compressor.stdin.close()
+        if compressor.wait() != 0:
+            logging.critical(f'{DebWriter.compression} failed with status {compressor.returncode}')
+            return False
+        end = deb.seek(0, os.SEEK_END)
+        size = end - header - 60
+        if size % 2:
+            deb.write(b'\n')
+        deb.seek(header)
+        deb.write(DebWriter.ar_header(name, size, mtime))
+        deb.seek(0, os.SEEK_END)
+        return True
+
+    @staticmethod
+    def check_control(path):
+        "check the fields dpkg-deb --build requires in the control file, False with the error logged if one is wrong"
+        fields = dict()
+        try:
+            with open(path) as file:
+                for line in file:
+                    if line[:1] in (' ', '\t') or not line.strip():
+                        continue
+                    name, colon, value = line.partition(':')
+                    if not colon:
+                        logging.critical(f'{path}: bad control line "{line.strip()}"')
+                        return False
+                    fields[name.strip().lower()] = value.strip()
+        except OSError as error:
+            logging.critical(f'can\'t read {path}: {error}')
+            return False
+        for name in ['package', 'version', 'architecture']:
+            if not fields.get(name):
+                logging.critical(f'{path}: field {name.capitalize()} is missing')
+                return False
+        # optional in the manifest, like dpkg-deb only warn about the fields apt expects
+        for name in ['maintainer', 'description']:
+            if not fields.get(name):
+                logging.warning(f'{path}: field {name.capitalize()} is missing')
+        if not re.fullmatch(DebWriter.package_syntax, fields['package']):
+            logging.critical(f'{path}: bad package name "{fields["package"]}"')
+            return False
+        if not re.fullmatch(DebWriter.version_syntax, fields['version']):
+            logging.critical(f'{path}: bad version "{fields["version"]}"')
+            return False
+        return True
+
+    @staticmethod
+    def write(install_dir, package_path):
+        "the package of install_dir (DEBIAN/ holding its control files) in package_path, False on failure"
+        if shutil.which(DebWriter.compression) is None:
+            logging.critical(f'{DebWriter.compression} is needed on the host to write the deb package')
+            return False
+        if not DebWriter.check_control(install_dir + '/DEBIAN/control'):
+            return False
+        suffix = {'xz': '.xz', 'zstd': '.zst'}[DebWriter.compression]
+        mtime = int(os.environ.get('SOURCE_DATE_EPOCH', time.time()))
+
+        def control(stream):
+            with tarfile.open(fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                DebWriter.add_tree(tar, install_dir + '/DEBIAN')
+
+        def data(stream):
+            with tarfile.open(fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                DebWriter.add_tree(tar, install_dir, skip='DEBIAN')
+
+        tmp = f'{package_path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w+b') as deb:
+            deb.write(b'!<arch>\n' + DebWriter.ar_header('debian-binary', 4, mtime) + b'2.0\n')
+            ok = DebWriter.member(deb, 'control.tar' + suffix, mtime, control) and \
+                DebWriter.member(deb, 'data.tar' + suffix, mtime, data)
+        if not ok:
+            os.remove(tmp)
+            return False
+        os.replace(tmp, package_path)
+        return True
+
+
+class RepositoryIndex:
+    "apt and yum repositories of the delivered packages, their metadata updated from a cached per-package index"
+    lock = threading.Lock()
+    # rpm header tags
+    tags = {'name': 1000, 'version': 1001, 'release': 1002, 'epoch': 1003, 'summary': 1004, 'description': 1005,
+            'buildtime': 1006, 'buildhost': 1007, 'size': 1009, 'vendor': 1011, 'license': 1014, 'packager': 1015,
+            'group': 1016, 'url': 1020, 'arch': 1022, 'filemodes': 1030, 'sourcerpm': 1044, 'archivesize': 1046,
+            'providename': 1047, 'requireflags': 1048, 'requirename': 1049, 'requireversion': 1050,
+            'changelogtime': 1080, 'changelogname': 1081, 'changelogtext': 1082, 'provideflags': 1112,
+            'provideversion': 1113, 'dirindexes': 1116, 'basenames': 1117, 'dirnames': 1118}
+    # sense flags of the rpm dependencies, and the ones marking a requirement of the install scripts
+    flags = {2: 'LT', 4: 'GT', 8: 'EQ', 10: 'LE', 12: 'GE'}
+    pre_flags = 64 | 512 | 1024
+
+    @staticmethod
+    def file_hashes(path):
+        digests = {'md5': hashlib.md5(), 'sha1': hashlib.sha1(), 'sha256': hashlib.sha256()}
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                for digest in digests.values():
+                    digest.update(chunk)
+        return {name: digest.hexdigest() for name, digest in digests.items()}
+
+    @staticmethod
+    def deb_control(path):
+        "the control file of a deb package, read from its control.tar member"
+        with open(path, 'rb') as deb:
+            if deb.read(8) != b'!<arch>\n':
+                raise ValueError('not a deb package')
+            while header := deb.read(60):
+                name = header[:16].decode().strip().rstrip('/')
+                size = int(header[48:58])
+                if not name.startswith('control.tar'):
+                    deb.seek(size + size % 2, os.SEEK_CUR)
+                    continue
+                data = deb.read(size)
+                if name.endswith('.zst'):
+                    data = subprocess.run(['zstd', '-dc'], input=data, capture_output=True, check=True).stdout
+                with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                    member = next(member for member in tar.getmembers()
+                                  if member.name in ('./control', 'control'))
+                    return tar.extractfile(member).read().decode().strip() + '\n'
+        raise ValueError('no control.tar in the deb package')
+
+    @staticmethod
+    def rpm_header(rpm, offset):
+        "the tag -> value dict of the rpm header at offset, and the offset of its end"
+        rpm.seek(offset)
+        head = rpm.read(16)
+        if head[:3] != b'\x8e\xad\xe8':
+            raise ValueError('not a rpm header')
+        count, size = int.from_bytes(head[8:12], 'big'), int.from_bytes(head[12:16], 'big')
+        entries = rpm.read(16 * count)
+        store = rpm.read(size)
+        values = dict()
+        for index in range(count):
+            tag, kind, start, number = (int.from_bytes(entries[16 * index + 4 * i:16 * index + 4 * i + 4], 'big')
+                                        for i in range(4))
+            if kind in (3, 4, 5):
+                width = {3: 2, 4: 4, 5: 8}[kind]
+                values[tag] = [int.from_bytes(store[start + width * i:start + width * (i + 1)], 'big')
+                               for i in range(number)]
+            elif kind in (6, 8, 9):
+                strings = store[start:].split(b'\0', number)[:number]
+                strings = [string.decode('utf-8', errors='replace') for string in strings]
+                # a string, or the first (untranslated) one of an i18n string
+                values[tag] = strings if kind == 8 else strings[0]
+            elif kind == 7:
+                values[tag] = store[start:start + number]
+        return values, offset + 16 + 16 * count + size
+
+    @staticmethod
+    def rpm_metadata(path):
+        "the fields of the yum repository metadata of a rpm package"
+        with open(path, 'rb') as rpm:
+            # 96 bytes lead, then the signature header padded to 8 bytes, then the header
+            signature, end = RepositoryIndex.rpm_header(rpm, 96)
+            start = end + (8 - end % 8) % 8
+            header, end = RepositoryIndex.rpm_header(rpm, start)
+        tags = RepositoryIndex.tags
+
+        def value(name, default=''):
+            return header.get(tags[name], default)
+
+        def deps(names, flags, versions):
+            entries = list()
+            for name, flag, version in zip(value(names, []), value(flags, []), value(versions, [])):
+                if name.startswith('rpmlib('):
+                    continue
+                entry = {'name': name}
+                if flag & 0xe:
+                    epoch, _, ver = version.rpartition(':')
+                    ver, _, rel = ver.partition('-')
+                    entry.update(flags=RepositoryIndex.flags.get(flag & 0xe, 'EQ'), epoch=epoch or '0', ver=ver)
+                    if rel:
+                        entry['rel'] = rel
+                if flag & RepositoryIndex.pre_flags:
+                    entry['pre'] = '1'
+                entries.append(entry)
+            return entries
+
+        dirnames = value('dirnames', [])
+        files = [dirnames[index] + base for index, base in zip(value('dirindexes', []), value('basenames', []))]
+        modes = value('filemodes', [])
+        return {'name': value('name'), 'arch': value('arch'), 'epoch': str((value('epoch', None) or [0])[0]),
+                'version': value('version'), 'release': value('release'), 'summary': value('summary'),
+                'description': value('description'), 'packager': value('packager'), 'url': value('url'),
+                'license': value('license'), 'vendor': value('vendor'), 'group': value('group'),
+                'buildhost': value('buildhost'), 'sourcerpm': value('sourcerpm'),
+                'buildtime': (value('buildtime', None) or [0])[0], 'installed': (value('size', None) or [0])[0],
+                'archive': (signature.get(1007) or value('archivesize', None) or [0])[0],
+                'header_range': [start, end],
+                'provides': deps('providename', 'provideflags', 'provideversion'),
+                'requires': deps('requirename', 'requireflags', 'requireversion'),
+                'files': [[file, 'dir' if index < len(modes) and stat.S_ISDIR(modes[index]) else '']
+                          for index, file in enumerate(files)],
+                'changelogs': [list(entry) for entry in zip(value('changelogtime', []), value('changelogname', []),
+                                                            value('changelogtext', []))]}
+
+    @staticmethod
+    def entry(path, info):
+        "the index entry of a package: size, mtime, hashes and control fields"
+        entry = {'size': info.st_size, 'mtime': info.st_mtime_ns}
+        entry.update(RepositoryIndex.file_hashes(path))
+        if path.endswith('.deb'):
+            entry['control'] = RepositoryIndex.deb_control(path)
+        else:
+            entry['rpm'] = RepositoryIndex.rpm_metadata(path)
+        return entry
+
+    @staticmethod
+    def write_deb(repo_dir, index):
+        "Packages, Packages.xz and Release of a flat apt repository"
+        stanzas = list()
+        architectures = set()
+        for name, entry in sorted(index.items()):
+            stanzas.append(entry['control'] + f'Filename: ./{name}\nSize: {entry["size"]}\nMD5sum: {entry["md5"]}\n'
+                           f'SHA1: {entry["sha1"]}\nSHA256: {entry["sha256"]}\n')
+            architectures.update(re.findall(r'^Architecture: *(\S+)', entry['control'], re.MULTILINE))
+        packages = ''.join(stanza + '\n' for stanza in stanzas).encode()
+        files = {'Packages': packages, 'Packages.xz': lzma.compress(packages)}
+        release = ['Date: ' + time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime()),
+                   'Architectures: ' + ' '.join(sorted(architectures))]
+        for field, algorithm in (('MD5Sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256')):
+            release.append(field + ':')
+            release += [f' {hashlib.new(algorithm, data).hexdigest()} {len(data)} {name}'
+                        for name, data in files.items()]
+        files['Release'] = ('\n'.join(release) + '\n').encode()
+        for name, data in files.items():
+            RepositoryIndex.replace(repo_dir + '/' + name, data)
+
+    @staticmethod
+    def rpm_package(name, entry, kind):
+        "the <package> element of the package name in primary, filelists or other"
+        rpm = entry['rpm']
+        attr = xml.sax.saxutils.quoteattr
+        text = xml.sax.saxutils.escape
+        version = f'<version epoch={attr(rpm["epoch"])} ver={attr(rpm["version"])} rel={attr(rpm["release"])}/>'
+        if kind == 'filelists':
+            files = ''.join(f'<file type="dir">{text(file)}</file>' if mode else f'<file>{text(file)}</file>'
+                            for file, mode in rpm['files'])
+            return (f'<package pkgid="{entry["sha256"]}" name={attr(rpm["name"])} arch={attr(rpm["arch"])}>'
+                    f'{version}{files}</package>\n')
+        if kind == 'other':
+            changelogs = ''.join(f'<changelog author={attr(author)} date="{date}">{text(log)}</changelog>'
+                                 for date, author, log in rpm['changelogs'])
+            return (f'<package pkgid="{entry["sha256"]}" name={attr(rpm["name"])} arch={attr(rpm["arch"])}>'
+                    f'{version}{changelogs}</package>\n')
+
+        def deps(kind):
+            entries = ''.join('<rpm:entry' + ''.join(f' {key}={attr(value)}' for key, value in dep.items()) + '/>'
+                              for dep in rpm[kind])
+            return f'<rpm:{kind}>{entries}</rpm:{kind}>' if entries else ''
+        # like createrepo, primary only lists the files dnf may need to resolve dependencies
+        files = ''.join(f'<file type="dir">{text(file)}</file>' if mode else f'<file>{text(file)}</file>'
+                        for file, mode in rpm['files']
+                        if file.startswith('/etc/') or 'bin/' in file or file == '/usr/lib/sendmail')
+        start, end = rpm['header_range']
+        return (f'<package type="rpm"><name>{text(rpm["name"])}</name><arch>{text(rpm["arch"])}</arch>{version}'
+                f'<checksum type="sha256" pkgid="YES">{entry["sha256"]}</checksum>'
+                f'<summary>{text(rpm["summary"])}</summary><description>{text(rpm["description"])}</description>'
+                f'<packager>{text(rpm["packager"])}</packager><url>{text(rpm["url"])}</url>'
+                f'<time file="{entry["mtime"] // 10 ** 9}" build="{rpm["buildtime"]}"/>'
+                f'<size package="{entry["size"]}" installed="{rpm["installed"]}" archive="{rpm["archive"]}"/>'
+                f'<location href={attr(name)}/><format><rpm:license>{text(rpm["license"])}</rpm:license>'
+                f'<rpm:vendor>{text(rpm["vendor"])}</rpm:vendor><rpm:group>{text(rpm["group"])}</rpm:group>'
+                f'<rpm:buildhost>{text(rpm["buildhost"])}</rpm:buildhost>'
+                f'<rpm:sourcerpm>{text(rpm["sourcerpm"])}</rpm:sourcerpm>'
+                f'<rpm:header-range start="{start}" end="{end}"/>{deps("provides")}{deps("requires")}{files}'
+                '</format></package>\n')
+
+    @staticmethod
+    def write_rpm(repo_dir, index):
+        "repodata/ of a yum repository: primary, filelists and other, listed by repomd.xml"
+        roots = {'primary': '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+                            'xmlns:rpm="http://linux.duke.edu/metadata/rpm"',
+                 'filelists': '<filelists xmlns="http://linux.duke.edu/metadata/filelists"',
+                 'other': '<otherdata xmlns="http://linux.duke.edu/metadata/other"'}
+        repodata = LocalDirectory(repo_dir + '/repodata', clear_if_exist=False).path
+        timestamp = int(time.time())
+        repomd = ['<?xml version="1.0" encoding="UTF-8"?>',
+                  '<repomd xmlns="http://linux.duke.edu/metadata/repo" xmlns:rpm="http://linux.duke.edu/metadata/rpm">',
+                  f'<revision>{timestamp}</revision>']
+        keep = {'repomd.xml'}
+        for kind, root in roots.items():
+            data = ('<?xml version="1.0" encoding="UTF-8"?>\n' + root + f' packages="{len(index)}">\n'
+                    + ''.join(RepositoryIndex.rpm_package(name, entry, kind) for name, entry in sorted(index.items()))
+                    + root.split()[0].replace('<', '</') + '>\n').encode()
+            compressed = gzip.compress(data, mtime=0)
+            checksum = hashlib.sha256(compressed).hexdigest()
+            # named by checksum, so that the clients never mix the files of two revisions
+            keep.add(f'{checksum}-{kind}.xml.gz')
+            RepositoryIndex.replace(f'{repodata}/{checksum}-{kind}.xml.gz', compressed)
+            repomd += [f'<data type="{kind}">', f'<checksum type="sha256">{checksum}</checksum>',
+                       f'<open-checksum type="sha256">{hashlib.sha256(data).hexdigest()}</open-checksum>',
+                       f'<location href="repodata/{checksum}-{kind}.xml.gz"/>', f'<timestamp>{timestamp}</timestamp>',
+                       f'<size>{len(compressed)}</size>', f'<open-size>{len(data)}</open-size>', '</data>']
+        RepositoryIndex.replace(repodata + '/repomd.xml', ('\n'.join(repomd + ['</repomd>']) + '\n').encode())
+        for name in set(os.listdir(repodata)) - keep:
+            os.remove(repodata + '/' + name)
+
+    @staticmethod
+    def replace(path, data):
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def link(src, dest):
+        "put the package src in the repository, as a hardlink unless it's on another filesystem"
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            return
+        tmp = f'{dest}.{threading.get_ident()}.tmp'
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copy2(src, tmp)
+        os.replace(tmp, dest)
+
+    @staticmethod
+    def update(output_dir, packages):
+        "add the (distro, version, package file) packages to <output_dir>/repo/<distro>-<version> and reindex them"
+        repos = dict()
+        for distro, version, package in packages:
+            repo_dir = LocalDirectory(os.path.join(output_dir, 'repo', distro + '-' + version),
+                                      clear_if_exist=False).path
+            RepositoryIndex.link(os.path.join(output_dir, package), os.path.join(repo_dir, package))
+            repos[repo_dir] = os.path.splitext(package)[1]
+        with RepositoryIndex.lock:
+            for repo_dir, suffix in repos.items():
+                index_path = repo_dir + '/.mdpack-index.json'
+                cached = Cache.load_json(index_path, dict())
+                index = dict()
+                indexed = 0
+                for name in sorted(os.listdir(repo_dir)):
+                    if not name.endswith(suffix):
+                        continue
+                    path = os.path.join(repo_dir, name)
+                    info = os.stat(path)
+                    entry = cached.get(name)
+                    # only a new or changed package is hashed and read
+                    if entry is None or (entry['size'], entry['mtime']) != (info.st_size, info.st_mtime_ns):
+                        try:
+                            entry = RepositoryIndex.entry(path, info)
+                        except (OSError, ValueError, EOFError, StopIteration, tarfile.TarError,
+                                subprocess.CalledProcessError) as exc:
+                            logging.critical(f'{path} can\'t be indexed: {exc!r}')
+                            continue
+                        indexed += 1
+                    index[name] = entry
+                if suffix == '.deb':
+                    RepositoryIndex.write_deb(repo_dir, index)
+                else:
+                    RepositoryIndex.write_rpm(repo_dir, index)
+                Cache.save_json(index_path, index)
+                logging.info(f'- repository {repo_dir}: {len(index)} packages, {indexed} indexed')
+
+
+class Cache:
+    "Persistent cache directory shared by the mdpack runs of the host"
+    root = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'mdpack')
+
+    @staticmethod
+    def dir(*names):
+        return LocalDirectory(os.path.join(Cache.root, *names), clear_if_exist=False).path
+
+    @staticmethod
+    def path(*names):
+        "the path of names in the cache, without creating anything, for the reads of --plan"
+        return os.path.join(Cache.root, *names)
+
+    @staticmethod
+    def load_json(path, default):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return default
+
+    @staticmethod
+    def save_json(path, data):
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(data, file, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+
+class StreamDemux:
+    "Split the multiplexed stdout/stderr stream of a container without tty, frames may span several chunks"
+
+    def __init__(self, stdout, stderr=None):
+        self.sinks = {1: stdout, 2: stderr or stdout}
+        self.buffer = b''
+
+    def feed(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 8:
+            size = int.from_bytes(self.buffer[4:8], 'big')
+            if len(self.buffer) < 8 + size:
+                break
+            sink = self.sinks.get(self.buffer[0])
+            if sink is not None:
+                sink(self.buffer[8:8 + size])
+            self.buffer = self.buffer[8 + size:]
+
+
+class HttpClient:
+    "Asyncio HTTP/1.1 client over a unix socket or TCP, the keep-alive connections are pooled"
+
+    def __init__(self, socket_path=None, host=None, port=None, prefix=''):
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        # prepended to every request path
+        self.prefix = prefix
+        self.idle = list()
+
+    async def connect(self):
+        if self.socket_path is not None:
+            return await asyncio.open_unix_connection(self.socket_path)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, query=None, body=None, content_type='application/json', sink=None):
+        "send a request, returns its status and body, the body chunks are given to sink as they come instead"
+        url = self.prefix + path + ('?' + urllib.parse.urlencode(query) if query else '')
+        # a file body is streamed from its start, like a tar archive
+        stream = body if hasattr(body, 'read') else None
+        if stream is not None:
+            body = None
+            length = os.fstat(stream.fileno()).st_size
+        elif body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        if stream is None:
+            length = len(body or b'')
+        head = f'{method} {url} HTTP/1.1\r\nHost: {self.host or "localhost"}\r\nContent-Length: {length}\r\n'
+        if body is not None or stream is not None:
+            head += f'Content-Type: {content_type}\r\n'
+        # a pooled connection may have been closed by the daemon meanwhile, then a new one is opened
+        while True:
+            pooled = bool(self.idle)
+            reader, writer = self.idle.pop() if pooled else await self.connect()
+            try:
+                writer.write(head.encode() + b'\r\n' + (body or b''))
+                if stream is not None:
+                    stream.seek(0)
+                    while data := stream.read(1 << 16):
+                        writer.write(data)
+                        await writer.drain()
+                await writer.drain()
+                status_line = await reader.readline()
+            except (ConnectionError, BrokenPipeError):
+                status_line = b''
+            if status_line or not pooled:
+                break
+            writer.close()
+        if not status_line:
+            writer.close()
+            raise ConnectionError(f'no response from {self.socket_path or self.host}')
+
+        try:
+            status = int(status_line.split()[1])
+            headers = dict()
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            chunks = list()
+            sink = sink or chunks.append
+            reusable = headers.get('connection', '').lower() != 'close'
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                while (size := int((await reader.readline()).split(b';')[0], 16)) != 0:
+                    sink(await reader.readexactly(size))
+                    await reader.readline()
+                while await reader.readline() not in (b'\r\n', b''):
+                    pass
+            elif 'content-length' in headers:
+                if int(headers['content-length']):
+                    sink(await reader.readexactly(int(headers['content-length'])))
+            elif status not in (204, 304):
+                # raw stream (exec, attach) up to the end of the connection
+                reusable = False
+                while data := await reader.read(1 << 16):
+                    sink(data)
+        except BaseException:
+            writer.close()
+            raise
+        if reusable:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, b''.join(chunks)
+
+
+class DockerEngine(HttpClient):
+    "Asyncio client of the Docker Engine API over its unix socket"
+    version = 'v1.41'
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, prefix='/' + DockerEngine.version)
+
+    async def ping(self):
+        status, _ = await self.request('GET', '/_ping')
+        return status == 200
+
+    async def inspect_image(self, image_tag):
+        status, body = await self.request('GET', f'/images/{urllib.parse.quote(image_tag)}/json')
+        return json.loads(body) if status == 200 else None
+
+    async def build(self, context_dir, image_tag, build_args, labels, no_cache, output):
+        "build an image from context_dir, its output is fed to output, returns 0 if it succeeded"
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode='w') as tar:
+            tar.add(context_dir, arcname='.')
+        query = {'t': image_tag, 'networkmode': 'host', 'rm': 1,
+                 'buildargs': json.dumps(dict(arg.split('=', 1) for arg in build_args)), 'labels': json.dumps(labels)}
+        if no_cache:
+            query['nocache'] = 1
+        errors = list()
+        partial = [b'']
+
+        # the build output is a stream of json messages, one per line
+        def messages(data):
+            lines = (partial[0] + data).split(b'\n')
+            partial[0] = lines.pop()
+            for message in (json.loads(line) for line in lines if line.strip()):
+                if 'error' in message:
+                    errors.append(message['error'])
+                    output(message['error'].encode() + b'\n')
+                elif 'stream' in message:
+                    output(message['stream'].encode())
+
+        status, body = await self.request('POST', '/build', query, context.getvalue(), 'application/x-tar',
+                                          sink=messages)
+        if status != 200:
+            output(body + b'\n')
+            return status
+        return 1 if errors else 0
+
+    async def info(self):
+        status, body = await self.request('GET', '/info')
+        return json.loads(body) if status == 200 else None
+
+    async def remove_image(self, image_tag):
+        await self.request('DELETE', f'/images/{urllib.parse.quote(image_tag)}')
+
+    async def remove_container(self, name):
+        await self.request('DELETE', f'/containers/{name}', {'force': 1})
+
+    async def create(self, image, command, name=None, binds=(), limits=None):
+        config = {'Image': image, 'Cmd': command, 'Tty': False,
+                  'HostConfig': {'Binds': list(binds), 'NetworkMode': 'host'}}
+        if limits and limits.get('cpus'):
+            config['HostConfig']['NanoCpus'] = int(limits['cpus'] * 1e9)
+        if limits and limits.get('memory'):
+            config['HostConfig']['Memory'] = limits['memory']
+        status, body = await self.request('POST', '/containers/create', {'name': name} if name else None, config)
+        if status != 201:
+            raise OSError(f'can\'t create a container from {image}: {body.decode("utf-8", errors="replace")}')
+        return json.loads(body)['Id']
+
+    async def run(self, image, command, binds, stdout, stderr=None, name=None, limits=None):
+        "run a container until it exits, its output is streamed to stdout and stderr, returns its exit status"
+        container = await self.create(image, command, name, binds, limits)
+        try:
+            status, body = await self.request('POST', f'/containers/{container}/start')
+            if status not in (204, 304):
+                raise OSError(f'can\'t start {image}: {body.decode("utf-8", errors="replace")}')
+            # follow the logs rather than attaching, so that the connection can go back to the pool
+            await self.request('GET', f'/containers/{container}/logs', {'follow': 1, 'stdout': 1, 'stderr': 1},
+                               sink=StreamDemux(stdout, stderr).feed)
+            status, body = await self.request('POST', f'/containers/{container}/wait')
+            return json.loads(body)['StatusCode'] if status == 200 else -1
+        finally:
+            await self.remove_container(container)
+
+    async def start(self, image, command, name, binds, limits=None):
+        container = await self.create(image, command, name, binds, limits)
+        status, body = await self.request('POST', f'/containers/{container}/start')
+        if status not in (204, 304):
+            raise OSError(f'can\'t start {image}: {body.decode("utf-8", errors="replace")}')
+
+    async def exec(self, name, command, user, output):
+        "run command in a running container, returns its exit status"
+        status, body = await self.request('POST', f'/containers/{name}/exec',
+                                          body={'Cmd': command, 'User': user, 'AttachStdout': True,
+                                                'AttachStderr': True})
+        if status != 201:
+            raise OSError(f'can\'t exec in {name}: {body.decode("utf-8", errors="replace")}')
+        exec_id = json.loads(body)['Id']
+        await self.request('POST', f'/exec/{exec_id}/start', body={'Detach': False, 'Tty': False},
+                           sink=StreamDemux(output).feed)
+        status, body = await self.request('GET', f'/exec/{exec_id}/json')
+        return json.loads(body)['ExitCode'] if status == 200 else -1
+
+    async def put_archive(self, name, archive):
+        "extract the tar archive file at the root of the container filesystem"
+        status, body = await self.request('PUT', f'/containers/{name}/archive', {'path': '/'}, archive,
+                                          'application/x-tar')
+        if status != 200:
+            raise OSError(f'can\'t copy into {name}: {body.decode("utf-8", errors="replace")}')
+
+    async def get_archive(self, name, path, sink):
+        "stream a tar archive of path in the container to sink"
+        status, _ = await self.request('GET', f'/containers/{name}/archive', {'path': path}, sink=sink)
+        if status != 200:
+            raise OSError(f'can\'t copy {path} from {name}, status {status}')
+
+
+class DockerCli:
+    "Docker operations run with the docker command line"
+    name = 'cli'
+
+    def __init__(self, host=None):
+        # the docker endpoint, $DOCKER_HOST when None
+        self.docker = ['docker'] + (['--host', host] if host else [])
+
+    def inspect_image(self, image_tag):
+        result = subprocess.run(self.docker + ['image', 'inspect', image_tag], capture_output=True)
+        if result.returncode != 0:
+            return None
+        return json.loads(result.stdout)[0]
+
+    def info(self):
+        result = subprocess.run(self.docker + ['info', '--format', '{{json .}}'], capture_output=True)
+        if result.returncode != 0:
+            return None
+        return json.loads(result.stdout)
+
+    def build(self, context_dir, image_tag, build_args, labels, no_cache=False):
+        args = self.docker + ['build', '--network', 'host']
+        for arg in build_args:
+            args += ['--build-arg', arg]
+        if no_cache:
+            args.append('--no-cache')
+        for label, value in labels.items():
+            args += ['--label', f'{label}={value}']
+        return Packager.run(args + ['--tag', image_tag, context_dir])
+
+    def remove_image(self, image_tag):
+        subprocess.run(self.docker + ['rmi', image_tag], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def remove_container(self, name):
+        subprocess.run(self.docker + ['rm', '--force', name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @staticmethod
+    def limit_args(limits):
+        args = list()
+        if limits and limits.get('cpus'):
+            args += ['--cpus', f'{limits["cpus"]:g}']
+        if limits and limits.get('memory'):
+            args += ['--memory', str(limits['memory'])]
+        return args
+
+    def run(self, image, command, binds, name=None, tty=False, limits=None):
+        args = self.docker + ['run'] + (['-it'] if tty else []) + ['--net=host', '--rm'] + DockerCli.limit_args(limits)
+        if name is not None:
+            args += ['--name', name]
+        for bind in binds:
+            args += ['-v', bind]
+        return Packager.run(args + [image] + command)
+
+    def start(self, image, command, name, binds, limits=None):
+        args = self.docker + ['run', '--detach', '--net=host', '--name', name] + DockerCli.limit_args(limits)
+        for bind in binds:
+            args += ['-v', bind]
+        return Packager.run(args + [image] + command)
+
+    def exec(self, name, command, user):
+        return Packager.run(self.docker + ['exec', '--user', user, name] + command)
+
+    def capture(self, image, command):
+        "the stdout of command run in a new container of image, None if it failed"
+        result = subprocess.run(self.docker + ['run', '--rm', image] + command, capture_output=True)
+        if result.returncode != 0:
+            logging.critical(result.stderr.decode('utf-8', errors='replace'))
+            return None
+        return result.stdout
+
+    def copy_to(self, name, entries):
+        "send the (path, arcname) entries to the root of the container as a tar stream"
+        with Docker.pack(entries) as archive:
+            result = subprocess.run(self.docker + ['cp', '-', name + ':/'], stdin=archive, capture_output=True)
+        if result.returncode != 0:
+            logging.critical(f'docker cp into {name}: ' + result.stderr.decode('utf-8', errors='replace').strip())
+            return False
+        return True
+
+    def copy_from(self, name, path, dest_dir):
+        "extract path of the container into dest_dir, streamed as a tar archive"
+        process = subprocess.Popen(self.docker + ['cp', name + ':' + path, '-'], stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                SafeTar.extractall(tar, dest_dir)
+        except (tarfile.TarError, OSError) as exc:
+            logging.debug(f'docker cp {name}:{path}: {exc}')
+        process.stdout.read()
+        if process.wait() != 0:
+            error = process.stderr.read().decode('utf-8', errors='replace').strip()
+            logging.critical(f'docker cp {name}:{path}: {error}')
+            return False
+        return True
+
+
+class DockerApi:
+    "Docker operations sent to the Engine API, DockerEngine running in a background event loop"
+    name = 'api'
+
+    def __init__(self, socket_path):
+        self.engine = DockerEngine(socket_path)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='docker-api', daemon=True).start()
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def command(self, coroutine, output):
+        "the result of a command streaming its output, False when it fails"
+        try:
+            status = self.call(coroutine)
+        except (OSError, ValueError, EOFError) as exc:
+            output.close()
+            logging.critical(f'{output.command}: {exc}')
+            return False
+        if status:
+            return output.failed(status)
+        output.close()
+        return True
+
+    def inspect_image(self, image_tag):
+        return self.call(self.engine.inspect_image(image_tag))
+
+    def build(self, context_dir, image_tag, build_args, labels, no_cache=False):
+        output = CommandOutput(f'docker build {image_tag} {context_dir}')
+        return self.command(self.engine.build(context_dir, image_tag, build_args, labels, no_cache, output.feed),
+                            output)
+
+    def remove_image(self, image_tag):
+        self.call(self.engine.remove_image(image_tag))
+
+    def remove_container(self, name):
+        self.call(self.engine.remove_container(name))
+
+    def run(self, image, command, binds, name=None, tty=False, limits=None):
+        output = CommandOutput(f'docker run {image} ' + ' '.join(command))
+        return self.command(self.engine.run(image, command, binds, output.feed, name=name, limits=limits), output)
+
+    def start(self, image, command, name, binds, limits=None):
+        output = CommandOutput(f'docker start {name} {image} ' + ' '.join(command))
+        return self.command(self.engine.start(image, command, name, binds, limits), output)
+
+    def exec(self, name, command, user):
+        output = CommandOutput(f'docker exec --user {user} {name} ' + ' '.join(command))
+        return self.command(self.engine.exec(name, command, user, output.feed), output)
+
+    def capture(self, image, command):
+        stdout = list()
+        stderr = list()
+        try:
+            status = self.call(self.engine.run(image, command, [], stdout.append, stderr.append))
+        except (OSError, ValueError, EOFError) as exc:
+            logging.critical(f'docker run {image}: {exc}')
+            return None
+        if status != 0:
+            logging.critical(b''.join(stderr).decode('utf-8', errors='replace'))
+            return None
+        return b''.join(stdout)
+
+    def info(self):
+        try:
+            return self.call(self.engine.info())
+        except (OSError, ValueError, EOFError) as exc:
+            logging.debug(f'docker info: {exc}')
+            return None
+
+    def copy_to(self, name, entries):
+        with Docker.pack(entries) as archive:
+            try:
+                self.call(self.engine.put_archive(name, archive))
+            except (OSError, ValueError, EOFError) as exc:
+                logging.critical(f'docker cp into {name}: {exc}')
+                return False
+        return True
+
+    def copy_from(self, name, path, dest_dir):
+        with tempfile.TemporaryFile() as archive:
+            try:
+                self.call(self.engine.get_archive(name, path, archive.write))
+                archive.seek(0)
+                with tarfile.open(fileobj=archive) as tar:
+                    SafeTar.extractall(tar, dest_dir)
+            except (OSError, ValueError, EOFError, tarfile.TarError) as exc:
+                logging.critical(f'docker cp {name}:{path}: {exc}')
+                return False
+        return True
+
+
+class Docker:
+    "The docker backend: the Engine API over the unix socket when it answers, else the docker command line"
+    backend = DockerCli()
+
+    @staticmethod
+    def socket_path(host=None):
+        host = host or os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock')
+        return host[len('unix://'):] if host.startswith('unix://') else None
+
+    @staticmethod
+    def connect(mode, host=None):
+        "the backend of the endpoint host ($DOCKER_HOST when None), None if the api is required but doesn't answer"
+        if mode == 'cli':
+            return DockerCli(host)
+        path = Docker.socket_path(host)
+        if path is not None and os.path.exists(path):
+            api = DockerApi(path)
+            try:
+                if api.call(api.engine.ping()):
+                    return api
+            except (OSError, ValueError, EOFError) as exc:
+                logging.debug(f'docker api on {path}: {exc}')
+        if mode == 'api':
+            logging.critical(f'the docker Engine API doesn\'t answer on {path}')
+            return None
+        return DockerCli(host)
+
+    @staticmethod
+    def select(mode):
+        "choose the backend among auto, api and cli, False if the api is required but doesn't answer"
+        backend = Docker.connect(mode)
+        if backend is None:
+            return False
+        Docker.backend = backend
+        return True
+
+    @staticmethod
+    def current():
+        "the backend of the docker host the target of this thread is placed on"
+        host = DockerHosts.current()
+        return host.backend if host is not None else Docker.backend
+
+    @staticmethod
+    def key(image_tag):
+        "image_tag qualified by the docker host of this thread, images are built once per host"
+        host = DockerHosts.current()
+        return host.endpoint + '#' + image_tag if host is not None else image_tag
+
+    @staticmethod
+    def pack(entries):
+        "a temporary tar file of the (path, arcname) entries, owned by root once extracted in a container"
+        def root(info):
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            return info
+        archive = tempfile.TemporaryFile()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for path, arcname in entries:
+                tar.add(path, arcname=arcname, filter=root)
+        archive.seek(0)
+        return archive
+
+
+class DockerHost:
+    "A docker endpoint of --hosts, which can't mount the local directories: the files are copied as tar streams"
+
+    def __init__(self, endpoint, backend, slots, info):
+        self.endpoint = endpoint
+        self.backend = backend
+        # number of targets run at once on the host
+        self.slots = slots
+        self.cpus = int(info.get('NCPU') or 1)
+        self.memory = int(info.get('MemTotal') or 0)
+        self.running = 0
+        # image_tag -> context hash of the images found on the host
+        self.images = dict()
+
+    def free_cpus(self):
+        return self.cpus * (self.slots - self.running) / self.slots
+
+    def has_image(self, image_tag, context_hash):
+        if ImageCache.verified.get(self.endpoint + '#' + image_tag) == context_hash:
+            return True
+        if image_tag not in self.images:
+            self.images[image_tag] = ImageCache.image_hash(image_tag, self.backend)
+        return self.images[image_tag] == context_hash
+
+
+class DockerHosts:
+    "The docker hosts of --hosts, each target is placed on a host having its image, else with the most free cores"
+    hosts = list()
+    condition = threading.Condition()
+    local = threading.local()
+    context_hashes = dict()
+
+    @staticmethod
+    def connect(spec, mode, jobs):
+        "connect the hosts of 'ENDPOINT[=SLOTS],...', False if one of them doesn't answer"
+        items = [item.strip() for item in spec.split(',') if item.strip()]
+        for item in items:
+            endpoint, _, slots = item.rpartition('=')
+            if not endpoint or not slots.isdigit():
+                endpoint, slots = item, None
+            # a bare path is a unix socket
+            if '://' not in endpoint:
+                endpoint = 'unix://' + os.path.abspath(endpoint)
+            backend = Docker.connect(mode, endpoint)
+            info = backend.info() if backend is not None else None
+            if info is None:
+                logging.critical(f'docker doesn\'t answer on {endpoint}')
+                return False
+            # by default the targets run at once are spread evenly over the hosts
+            slots = int(slots) if slots else max(1, math.ceil(jobs / len(items)))
+            host = DockerHost(endpoint, backend, max(1, slots), info)
+            logging.debug(f'docker host {endpoint}: {backend.name}, {host.cpus} cores, {host.slots} slots')
+            DockerHosts.hosts.append(host)
+        return bool(DockerHosts.hosts)
+
+    @staticmethod
+    def current():
+        return getattr(DockerHosts.local, 'host', None)
+
+    @staticmethod
+    def place(job):
+        "wait for a free slot then take it on the host having the target image, else with the most free cores"
+        with DockerHosts.condition:
+            if job.image_tag not in DockerHosts.context_hashes:
+                DockerHosts.context_hashes[job.image_tag] = Packager.image_context(job.distro, job.version)[2]
+            context_hash = DockerHosts.context_hashes[job.image_tag]
+            while not (free := [host for host in DockerHosts.hosts if host.running < host.slots]):
+                DockerHosts.condition.wait()
+            host = max(free, key=lambda host: (host.has_image(job.image_tag, context_hash), host.free_cpus()))
+            host.running += 1
+        DockerHosts.local.host = host
+        return host
+
+    @staticmethod
+    def release(host):
+        DockerHosts.local.host = None
+        with DockerHosts.condition:
+            host.running -= 1
+            DockerHosts.condition.notify()
+
+
+class ImageCache:
+    "Skip docker build when an image was already built from the same context and build args"
+    label = 'mdpack.context-hash'
+    # images verified during this invocation, Docker.key(image_tag) -> hash
+    verified = dict()
+
+    @staticmethod
+    def context_hash(context_dir, build_args):
+        "hash the files of the build context (names, modes, contents) and the build args"
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(context_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, context_dir).encode() + b'\0')
+                digest.update(oct(os.stat(path).st_mode & 0o777).encode() + b'\0')
+                with open(path, 'rb') as file:
+                    for chunk in iter(lambda: file.read(1 << 16), b''):
+                        digest.update(chunk)
+        for arg in sorted(build_args):
+            digest.update(b'\0' + arg.encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def image_hash(image_tag, backend=None):
+        "the context hash label of an existing image, None if the image doesn't exist"
+        image = (backend or Docker.current()).inspect_image(image_tag)
+        if image is None:
+            return None
+        return ((image.get('Config') or dict()).get('Labels') or dict()).get(ImageCache.label, '')
+
+    @staticmethod
+    def image_size(image_tag):
+        image = Docker.current().inspect_image(image_tag)
+        return int(image.get('Size') or 0) if image else 0
+
+    @staticmethod
+    def image_id(image_tag):
+        "the id of an existing image, None if the image doesn't exist"
+        image = Docker.current().inspect_image(image_tag)
+        return image['Id'] if image else None
+
+
+class ImagePaths:
+    "Index of the paths of an image, cached by image id in <cache-dir>/image-paths"
+    indexes = dict()
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(image_tag):
+        "the set of the paths of image_tag filesystem, None if it can't be listed"
+        image_id = ImageCache.image_id(image_tag)
+        if image_id is None:
+            return None
+        with ImagePaths.lock:
+            if image_id in ImagePaths.indexes:
+                return ImagePaths.indexes[image_id]
+            path = Cache.dir('image-paths') + '/' + image_id.replace(':', '-') + '.gz'
+            try:
+                with gzip.open(path, 'rb') as file:
+                    paths = file.read()
+            except OSError:
+                logging.info(f'- indexing the paths of {image_tag}')
+                paths = Docker.current().capture(image_tag, ['find', '/', '-xdev', '-print0'])
+                if paths is None:
+                    return None
+                tmp = f'{path}.{os.getpid()}.tmp'
+                with gzip.open(tmp, 'wb') as file:
+                    file.write(paths)
+                os.replace(tmp, path)
+            index = set(paths.decode('utf-8', errors='surrogateescape').split('\0'))
+            index.discard('')
+            ImagePaths.indexes[image_id] = index
+            return index
+
+
+class DepsImageCache:
+    "Images derived from the distro images with the user build deps installed, evicted LRU above a size limit"
+    max_size = 20 * 1024 ** 3
+    lock = threading.Lock()
+
+    @staticmethod
+    def deps_list(manifest):
+        "the resolved build deps, sorted so that their order in the manifest doesn't matter"
+        deps = getattr(manifest.app.build, 'deps', None)
+        if not deps:
+            return []
+        if isinstance(deps, str):
+            deps = deps.split()
+        return sorted(str(dep) for dep in deps)
+
+    @staticmethod
+    def image_tag(base_tag, base_hash, script, deps):
+        digest = hashlib.sha256(base_hash.encode())
+        with open(script, 'rb') as file:
+            digest.update(file.read())
+        digest.update('\0'.join(deps).encode())
+        return f'{base_tag}-deps-{digest.hexdigest()[:16]}'
+
+    @staticmethod
+    def index_path():
+        return Cache.dir() + '/deps-images.json'
+
+    @staticmethod
+    def touch(image_tag, size=None):
+        "mark a derived image as used now, then evict the least recently used ones of its host above max_size"
+        with DepsImageCache.lock:
+            index = Cache.load_json(DepsImageCache.index_path(), dict())
+            entry = index.setdefault(Docker.key(image_tag), {'size': 0})
+            entry['last_used'] = time.time()
+            if size is not None:
+                entry['size'] = size
+
+            # the keys of the images of the current docker host
+            host = DockerHosts.current()
+            endpoint = host.endpoint if host is not None else ''
+            keys = [key for key in index if key.rpartition('#')[0] == endpoint]
+            total = sum(index[key]['size'] for key in keys)
+            for key in sorted(keys, key=lambda key: index[key]['last_used']):
+                if total <= DepsImageCache.max_size:
+                    break
+                # never evict an image used by this invocation
+                if key in ImageCache.verified:
+                    continue
+                tag = key.rpartition('#')[2]
+                logging.info(f'- evicting deps image {tag}')
+                Docker.current().remove_image(tag)
+                if ImageCache.image_id(tag) is None:
+                    total -= index.pop(key)['size']
+            Cache.save_json(DepsImageCache.index_path(), index)
+
+
+class GitMirror:
+    "Bare mirrors of the git sources and their submodules, updated with git fetch and evicted LRU above a size limit"
+    max_size = 5 * 1024 ** 3
+    locks = dict()
+    locks_guard = threading.Lock()
+    # mirrors used by this invocation, never evicted
+    used = set()
+
+    @staticmethod
+    def path(url, create=True):
+        root = Cache.dir('git') if create else os.path.join(Cache.root, 'git')
+        return root + '/' + hashlib.sha256(url.encode()).hexdigest()[:16] + '.git'
+
+    @staticmethod
+    def git(args, quiet=False):
+        result = subprocess.run(['git'] + args, capture_output=True)
+        if result.returncode != 0 and not quiet:
+            logging.critical(result.stderr.decode('utf-8'))
+        return result
+
+    @staticmethod
+    def has(mirror, ref):
+        return GitMirror.git(['-C', mirror, 'rev-parse', '--verify', '--quiet', ref + '^{commit}'],
+                             quiet=True).returncode == 0
+
+    @staticmethod
+    def resolve(mirror, ref):
+        return GitMirror.git(['-C', mirror, 'rev-parse', '--verify', '--quiet', ref + '^{commit}'],
+                             quiet=True).stdout.decode('utf-8').strip()
+
+    @staticmethod
+    def update(url, refs):
+        "clone or fetch the mirror of url unless it already holds every ref, returns its path or None"
+        with GitMirror.locks_guard:
+            lock = GitMirror.locks.setdefault(url, threading.Lock())
+        mirror = GitMirror.path(url)
+        # another mdpack process may update the same mirror
+        with lock, open(mirror + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            GitMirror.used.add(mirror)
+            if not os.path.exists(mirror):
+                logging.info(f'- mirroring {url}')
+                if GitMirror.git(['clone', '--quiet', '--mirror', url, mirror]).returncode != 0:
+                    shutil.rmtree(mirror, ignore_errors=True)
+                    return None
+            elif all(GitMirror.has(mirror, ref) for ref in refs):
+                logging.debug(f'git mirror of {url} is up to date')
+            else:
+                logging.info(f'- fetching {url}')
+                if GitMirror.git(['-C', mirror, 'fetch', '--quiet', '--prune']).returncode != 0:
+                    return None
+            os.utime(mirror)
+        GitMirror.evict()
+        return mirror
+
+    @staticmethod
+    def evict():
+        "remove the least recently used mirrors when their total size exceeds max_size"
+        with GitMirror.locks_guard:
+            root = Cache.dir('git')
+            mirrors = [root + '/' + name for name in os.listdir(root) if name.endswith('.git')]
+            sizes = dict()
+            for mirror in mirrors:
+                sizes[mirror] = sum(os.path.getsize(os.path.join(path, name))
+                                    for path, dirs, files in os.walk(mirror) for name in files)
+            total = sum(sizes.values())
+            for mirror in sorted(mirrors, key=os.path.getmtime):
+                if total <= GitMirror.max_size:
+                    break
+                if mirror in GitMirror.used:
+                    continue
+                logging.info(f'- evicting git mirror {mirror}')
+                shutil.rmtree(mirror, ignore_errors=True)
+                if os.path.exists(mirror + '.lock'):
+                    os.remove(mirror + '.lock')
+                total -= sizes[mirror]
+
+    @staticmethod
+    def source_commit(source, fetch=True):
+        """Update the mirror of a git app.source, returns the mirror and the commit to build or None, None
+
+        Without fetch, the commit is only resolved from an existing mirror already holding the refs.
+        """
+        refs = list()
+        if hasattr(source, 'tag'):
+            refs.append(f'refs/tags/{source.tag}')
+        if hasattr(source, 'commit'):
+            refs.append(str(source.commit))
+        if not hasattr(source, 'url') or not refs:
+            return None, None
+        if fetch:
+            mirror = GitMirror.update(source.url, refs)
+        else:
+            mirror = GitMirror.path(source.url, create=False)
+            if not os.path.isdir(mirror) or not all(GitMirror.has(mirror, ref) for ref in refs):
+                mirror = None
+        if mirror is None:
+            return None, None
+
+        # check commit and tag match
+        commit = GitMirror.resolve(mirror, refs[0])
+        if not commit:
+            logging.critical(f'{refs[0]} not found in {source.url}')
+            return None, None
+        if len(refs) == 2 and GitMirror.resolve(mirror, refs[1]) != commit:
+            logging.critical(f'tag {source.tag} doesn\'t match commit {source.commit}')
+            return None, None
+        return mirror, commit
+
+    @staticmethod
+    def submodule_url(url, sub_url):
+        "resolve a relative submodule url against its superproject url"
+        if not sub_url.startswith('./') and not sub_url.startswith('../'):
+            return sub_url
+        base = url.rstrip('/')
+        for part in sub_url.split('/'):
+            if part == '..':
+                base = base.rsplit('/', 1)[0]
+            elif part != '.':
+                base += '/' + part
+        return base
+
+    @staticmethod
+    def checkout(url, mirror, commit, dest_dir):
+        "local clone (hardlinked objects) of the mirror then checkout, submodules are cloned from their own mirrors"
+        if GitMirror.git(['clone', '--quiet', '--local', '--no-checkout', mirror, dest_dir]).returncode != 0:
+            return False
+        GitMirror.git(['-C', dest_dir, 'remote', 'set-url', 'origin', url])
+        if GitMirror.git(['-C', dest_dir, 'checkout', '--quiet', commit]).returncode != 0:
+            return False
+
+        if not os.path.exists(dest_dir + '/.gitmodules'):
+            return True
+        urls = GitMirror.git(['-C', dest_dir, 'config', '-f', '.gitmodules', '--get-regexp', r'^submodule\..*\.url$'],
+                             quiet=True).stdout.decode('utf-8').split('\n')
+        for line in filter(None, urls):
+            key, sub_url = line.split(' ', 1)
+            name = key[len('submodule.'):-len('.url')]
+            sub_url = GitMirror.submodule_url(url, sub_url)
+            path = GitMirror.git(['-C', dest_dir, 'config', '-f', '.gitmodules', f'submodule.{name}.path'],
+                                 quiet=True).stdout.decode('utf-8').strip()
+            # the gitlink commit recorded in the superproject
+            tree = GitMirror.git(['-C', dest_dir, 'ls-tree', 'HEAD', path], quiet=True).stdout.decode('utf-8').split()
+            if len(tree) < 3 or tree[1] != 'commit':
+                continue
+            sub_mirror = GitMirror.update(sub_url, [tree[2]])
+            if sub_mirror is None:
+                return False
+            if not GitMirror.checkout(sub_url, sub_mirror, tree[2], dest_dir + '/' + path):
+                return False
+            GitMirror.git(['-C', dest_dir, 'config', f'submodule.{name}.url', sub_url])
+        return True
+
+
+class SourceSnapshot:
+    "Sources materialized once per manifest, shared by the targets through copy-on-write views"
+    # auto: reflink, else hardlink the read-only files and copy the others, else read-only bind mount
+    mode = 'auto'
+    snapshots = dict()
+    locks = dict()
+    locks_guard = threading.Lock()
+    stats = {'copied': 0, 'saved': 0, 'reflink': 0, 'hardlink': 0, 'copy': 0, 'bind': 0}
+
+    @staticmethod
+    def tree_size(path):
+        return sum(os.lstat(os.path.join(root, name)).st_size
+                   for root, dirs, files in os.walk(path) for name in files)
+
+    @staticmethod
+    def count(mode, copied, saved):
+        with SourceSnapshot.locks_guard:
+            if mode is not None:
+                SourceSnapshot.stats[mode] += 1
+            SourceSnapshot.stats['copied'] += copied
+            SourceSnapshot.stats['saved'] += saved
+
+    @staticmethod
+    def get(manifest_path, manifest, extract):
+        "path of the snapshot of the manifest sources, extract(dest_dir, manifest) materializes it the first time"
+        source = json.dumps(vars(manifest.app.source), sort_keys=True, default=str)
+        key = hashlib.sha256((os.path.realpath(manifest_path) + '\0' + source).encode()).hexdigest()[:16]
+        with SourceSnapshot.locks_guard:
+            lock = SourceSnapshot.locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in SourceSnapshot.snapshots:
+                path = LocalDirectory('mdp-src-' + key).path
+                if not extract(path, manifest):
+                    shutil.rmtree(path, ignore_errors=True)
+                    return None
+                SourceSnapshot.count(None, SourceSnapshot.tree_size(path), 0)
+                SourceSnapshot.snapshots[key] = path
+            return SourceSnapshot.snapshots[key]
+
+    @staticmethod
+    def link_tree(src, dest):
+        "hardlink the read-only files and copy the others, returns the copied and linked bytes"
+        copied = linked = 0
+        for root, dirs, files in os.walk(src):
+            target = os.path.join(dest, os.path.relpath(root, src))
+            os.makedirs(target, exist_ok=True)
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                info = os.lstat(path)
+                if stat.S_ISLNK(info.st_mode):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                elif stat.S_ISDIR(info.st_mode):
+                    continue
+                elif info.st_mode & 0o222 == 0:
+                    os.link(path, os.path.join(target, name))
+                    linked += info.st_size
+                else:
+                    shutil.copy2(path, os.path.join(target, name))
+                    copied += info.st_size
+            # symlinked dirs were recreated as links, don't walk into them
+            dirs[:] = [name for name in dirs if not os.path.islink(os.path.join(root, name))]
+        return copied, linked
+
+    @staticmethod
+    def view(snapshot, dest_dir):
+        "populate dest_dir from the snapshot, returns the mode used, 'bind' meaning dest_dir must be mounted on it"
+        size = SourceSnapshot.tree_size(snapshot)
+        if SourceSnapshot.mode == 'bind':
+            SourceSnapshot.count('bind', 0, size)
+            return 'bind'
+        if SourceSnapshot.mode == 'copy':
+            if not Packager.run(['cp', '-rp', snapshot + '/.', dest_dir]):
+                return None
+            SourceSnapshot.count('copy', size, 0)
+            return 'copy'
+
+        if subprocess.run(['cp', '-a', '--reflink=always', snapshot + '/.', dest_dir],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            SourceSnapshot.count('reflink', 0, size)
+            return 'reflink'
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        try:
+            copied, linked = SourceSnapshot.link_tree(snapshot, dest_dir)
+            SourceSnapshot.count('hardlink', copied, linked)
+            return 'hardlink'
+        except OSError as exc:
+            logging.debug(f'can\'t hardlink {snapshot} into {dest_dir}: {exc}')
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        SourceSnapshot.count('bind', 0, size)
+        return 'bind'
+
+    @staticmethod
+    def clear():
+        for path in SourceSnapshot.snapshots.values():
+            shutil.rmtree(path, ignore_errors=True)
+        SourceSnapshot.snapshots.clear()
+
+    @staticmethod
+    def report():
+        stats = SourceSnapshot.stats
+        logging.info(f'sources: {stats["copied"]} bytes copied, {stats["saved"]} bytes saved '
+                     f'({stats["reflink"]} reflink, {stats["hardlink"]} hardlink, '
+                     f'{stats["copy"]} copy, {stats["bind"]} bind views)')
+
+
+class HashingReader:
+    "File object hashing what is read from it, and copying it into tee when given"
+
+    def __init__(self, stream, tee=None):
+        self.stream = stream
+        self.tee = tee
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        if self.tee is not None:
+            self.tee.write(data)
+        return data
+
+    def drain(self):
+        "read what the extraction left, like the tar end padding, so that the whole archive is hashed"
+        while self.read(1 << 20):
+            pass
+
+
+class ArchiveSource:
+    "tar.gz/xz/bz2/zst and zip sources streamed into the sources dir, downloads are cached by sha256"
+    max_size = 5 * 1024 ** 3
+    locks = dict()
+    locks_guard = threading.Lock()
+
+    @staticmethod
+    def local_path(location):
+        "the path of a local or file:// archive, None for a remote one"
+        url = urllib.parse.urlparse(location)
+        if url.scheme == 'file':
+            return urllib.request.url2pathname(url.path)
+        if url.scheme == '':
+            return location
+        return None
+
+    @staticmethod
+    def cached(sha256):
+        path = Cache.dir('archives') + '/' + sha256 if sha256 else None
+        if path is None or not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    @staticmethod
+    def known_sha256(location):
+        "sha256 of a previous download of location, for the archives without app.source.sha256"
+        return Cache.load_json(Cache.path('archives', 'urls.json'), dict()).get(location)
+
+    @staticmethod
+    def keep(tmp, location, sha256):
+        os.replace(tmp, Cache.dir('archives') + '/' + sha256)
+        with ArchiveSource.locks_guard:
+            urls_path = Cache.dir('archives') + '/urls.json'
+            urls = Cache.load_json(urls_path, dict())
+            urls[location] = sha256
+            Cache.save_json(urls_path, urls)
+        ArchiveSource.evict()
+
+    @staticmethod
+    def evict():
+        "remove the least recently used archives when their total size exceeds max_size"
+        root = Cache.dir('archives')
+        archives = [root + '/' + name for name in os.listdir(root) if len(name) == 64]
+        total = sum(os.path.getsize(path) for path in archives)
+        for path in sorted(archives, key=os.path.getmtime):
+            if total <= ArchiveSource.max_size:
+                break
+            logging.info(f'- evicting archive {os.path.basename(path)}')
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    @staticmethod
+    def hoist(dest_dir):
+        "archives usually hold a single <name>-<version> directory, its content becomes the sources"
+        entries = os.listdir(dest_dir)
+        if len(entries) != 1 or not os.path.isdir(dest_dir + '/' + entries[0]) \
+                or os.path.islink(dest_dir + '/' + entries[0]):
+            return
+        top = dest_dir + '/' + entries[0]
+        moved = dest_dir + '/.mdpack-' + entries[0]
+        os.rename(top, moved)
+        for name in os.listdir(moved):
+            os.rename(moved + '/' + name, dest_dir + '/' + name)
+        os.rmdir(moved)
+
+    @staticmethod
+    def extract_tar(reader, location, dest_dir):
+        if not location.endswith(('.zst', '.tzst')):
+            # stream mode, the compression is detected from the content
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                SafeTar.extractall(tar, dest_dir)
+            return True
+        zstd = subprocess.Popen(['zstd', '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def feed():
+            for chunk in iter(lambda: reader.read(1 << 20), b''):
+                zstd.stdin.write(chunk)
+            zstd.stdin.close()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        with tarfile.open(fileobj=zstd.stdout, mode='r|') as tar:
+            SafeTar.extractall(tar, dest_dir)
+        while zstd.stdout.read(1 << 20):
+            pass
+        feeder.join()
+        return zstd.wait() == 0
+
+    @staticmethod
+    def extract(source, dest_dir):
+        "extract the archive of app.source into dest_dir, verifying its app.source.sha256 if given"
+        location = str(getattr(source, 'url', '') or getattr(source, 'path', ''))
+        if not location:
+            logging.critical('app.source.url or app.source.path is required for archive type')
+            return False
+        expected = str(getattr(source, 'sha256', '') or '').lower() or None
+        LocalDirectory(dest_dir)
+
+        with ArchiveSource.locks_guard:
+            lock = ArchiveSource.locks.setdefault(location, threading.Lock())
+        with lock:
+            path = ArchiveSource.cached(expected or ArchiveSource.known_sha256(location)) \
+                or ArchiveSource.local_path(location)
+            tmp = None
+            if path is not None:
+                logging.debug(f'extracting {path}')
+                try:
+                    stream = open(path, 'rb')
+                except OSError as exc:
+                    logging.critical(f'can\'t open {location}: {exc}')
+                    return False
+            else:
+                logging.info(f'- downloading {location}')
+                tmp = Cache.dir('archives') + f'/download.{os.getpid()}.{threading.get_ident()}'
+                try:
+                    stream = urllib.request.urlopen(location)
+                except (OSError, ValueError, EOFError) as exc:
+                    logging.critical(f'can\'t download {location}: {exc}')
+                    return False
+
+            try:
+                with stream, open(tmp, 'wb') if tmp else contextlib.nullcontext() as tee:
+                    reader = HashingReader(stream, tee)
+                    if location.endswith('.zip'):
+                        # a zip file is read from its end, it must be complete and verified before extraction
+                        reader.drain()
+                        ok = True
+                    else:
+                        ok = ArchiveSource.extract_tar(reader, location, dest_dir)
+                        reader.drain()
+            except (OSError, ValueError, tarfile.TarError, EOFError) as exc:
+                logging.critical(f'can\'t extract {location}: {exc}')
+                ok = False
+
+            sha256 = reader.digest.hexdigest() if ok else None
+            if ok and expected is not None and sha256 != expected:
+                logging.critical(f'sha256 mismatch for {location}: expected {expected}, got {sha256}')
+                ok = False
+            if not ok:
+                if tmp is not None and os.path.exists(tmp):
+                    os.remove(tmp)
+                LocalDirectory(dest_dir)
+                return False
+            if expected is None:
+                logging.warning(f'app.source.sha256 is missing, {location} has sha256 {sha256}')
+            if tmp is not None:
+                ArchiveSource.keep(tmp, location, sha256)
+                path = ArchiveSource.cached(sha256)
+
+        if location.endswith('.zip'):
+            try:
+                with zipfile.ZipFile(path) as archive:
+                    archive.extractall(dest_dir)
+            except (OSError, zipfile.BadZipFile) as exc:
+                logging.critical(f'can\'t extract {location}: {exc}')
+                return False
+        ArchiveSource.hoist(dest_dir)
+        return True
+
+    @staticmethod
+    def source_hash(source):
+        "sha256 of the archive without downloading it, None if it's unknown"
+        location = str(getattr(source, 'url', '') or getattr(source, 'path', ''))
+        expected = str(getattr(source, 'sha256', '') or '').lower()
+        if expected:
+            return expected
+        path = ArchiveSource.local_path(location)
+        if path is not None and os.path.isfile(path):
+            return Fingerprint.file_digest(path)
+        return ArchiveSource.known_sha256(location)
+
+
+class Fingerprint:
+    "Content hash of a directory tree, the digests of unchanged files (same size, mtime, inode) are cached"
+    memo = dict()
+    locks = dict()
+    locks_guard = threading.Lock()
+
+    @staticmethod
+    def file_digest(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def tree(path, save=True):
+        path = os.path.realpath(path)
+        with Fingerprint.locks_guard:
+            lock = Fingerprint.locks.setdefault(path, threading.Lock())
+        with lock:
+            if path in Fingerprint.memo:
+                return Fingerprint.memo[path]
+            index_dir = Cache.dir('fingerprints') if save else os.path.join(Cache.root, 'fingerprints')
+            index_path = index_dir + '/' + hashlib.sha256(path.encode()).hexdigest()[:16] + '.json'
+            old_index = Cache.load_json(index_path, dict())
+            index = dict()
+            digest = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    rel = os.path.relpath(file_path, path)
+                    info = os.lstat(file_path)
+                    signature = [info.st_size, info.st_mtime_ns, info.st_ino]
+                    entry = old_index.get(rel)
+                    if entry is not None and entry[:3] == signature:
+                        file_digest = entry[3]
+                    elif stat.S_ISLNK(info.st_mode):
+                        file_digest = hashlib.sha256(os.readlink(file_path).encode()).hexdigest()
+                    else:
+                        file_digest = Fingerprint.file_digest(file_path)
+                    index[rel] = signature + [file_digest]
+                    digest.update(f'{rel}\0{oct(info.st_mode)}\0{file_digest}\0'.encode())
+            if not save:
+                return digest.hexdigest()
+            Cache.save_json(index_path, index)
+            Fingerprint.memo[path] = digest.hexdigest()
+            return Fingerprint.memo[path]
+
+
+class ArtifactStore:
+    "Delivered packages and their test result, stored by the hash of all the inputs of their build"
+    lock = threading.Lock()
+    # why --plan can't know the image or the source, by source type, before building
+    unknown = {'image': 'image to build', 'dir': 'source dir missing', 'git': 'git commit not fetched',
+               'archive': 'archive not downloaded'}
+
+    @staticmethod
+    def target_key(job):
+        return f'{os.path.realpath(job.path)}:{job.distro}:{job.version}:{job.manifest.pkg.package}'
+
+    @staticmethod
+    def source_hash(manifest, dry_run=False):
+        "the hash of the app source, None if it can't be known, without writing anything in dry_run"
+        source = manifest.app.source
+        match source.type:
+            case 'dir':
+                if hasattr(source, 'path') and os.path.isdir(source.path):
+                    return Fingerprint.tree(source.path, save=not dry_run)
+            case 'git':
+                # missing fields are reported by extract_source
+                mirror, commit = GitMirror.source_commit(source, fetch=not dry_run)
+                return commit
+            case 'archive':
+                return ArchiveSource.source_hash(source)
+        return None
+
+    @staticmethod
+    def inputs(job, image_id, dry_run=False):
+        "the hashes of every input of the build of a target, None for the ones that can't be known yet"
+        source = ArtifactStore.source_hash(job.manifest, dry_run)
+        scripts = hashlib.sha256()
+        for path in ['mdpack/scripts', 'mdpack/distro/' + job.distro]:
+            scripts.update(ImageCache.context_hash(path, []).encode())
+        scripts.update(Fingerprint.file_digest(os.path.realpath(__file__)).encode())
+        manifest = json.dumps(job.manifest_dict, sort_keys=True, default=str)
+        return {
+            'manifest': hashlib.sha256(manifest.encode()).hexdigest(),
+            'source': source,
+            'scripts': scripts.hexdigest(),
+            'image': image_id or None
+        } | ArtifactStore.deb_writer(job.manifest)
+
+    @staticmethod
+    def complete(inputs):
+        "whether every input is known, a package is looked up and stored only then"
+        return None not in inputs.values()
+
+    @staticmethod
+    def deb_writer(manifest):
+        "the options writing a deb package, the compression ones only matter to the host writer"
+        if manifest.pkg.type != 'deb':
+            return dict()
+        if Options.args.deb_writer != 'host':
+            return {'deb_writer': Options.args.deb_writer}
+        return {'deb_writer': f'host:{Options.args.deb_compression}:{Options.args.deb_level}'}
+
+    @staticmethod
+    def key(inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def lookup(inputs):
+        "the stored package built from these inputs, None if there is none"
+        entry = Cache.path('artifacts', ArtifactStore.key(inputs))
+        result = Cache.load_json(entry + '/result.json', None)
+        if result is None or result.get('test') != 'passed' or not os.path.exists(entry + '/' + result['package']):
+            return None
+        return entry + '/' + result['package']
+
+    @staticmethod
+    def store(job, inputs, package_path, package):
+        "store the tested package_path as package, returns its path in the store"
+        entry = LocalDirectory(Cache.dir('artifacts') + '/' + ArtifactStore.key(inputs), clear_if_exist=False).path
+        # a submission of mdpack serve may be delivering the same entry
+        tmp = f'{entry}/{package}.{threading.get_ident()}.tmp'
+        shutil.copyfile(package_path, tmp)
+        os.replace(tmp, entry + '/' + package)
+        Cache.save_json(entry + '/result.json', {'package': package, 'test': 'passed', 'inputs': inputs,
+                                                 'target': ArtifactStore.target_key(job), 'time': time.time()})
+        with ArtifactStore.lock:
+            targets_path = Cache.dir('artifacts') + '/targets.json'
+            targets = Cache.load_json(targets_path, dict())
+            targets[ArtifactStore.target_key(job)] = inputs
+            Cache.save_json(targets_path, targets)
+        return entry + '/' + package
+
+    @staticmethod
+    def why(job, inputs):
+        "the reason why a target has to be built, None if its package is in the store"
+        if ArtifactStore.complete(inputs) and ArtifactStore.lookup(inputs) is not None:
+            return None
+        last = Cache.load_json(Cache.path('artifacts', 'targets.json'), dict()).get(ArtifactStore.target_key(job))
+        if last is None:
+            return 'never built'
+        if not ArtifactStore.complete(inputs):
+            source_type = job.manifest.app.source.type
+            return ', '.join(ArtifactStore.unknown.get(source_type if name == 'source' else name, name + ' unknown')
+                             for name in inputs if inputs[name] is None)
+        changed = [name for name in inputs if inputs[name] != last.get(name)]
+        if changed:
+            return ', '.join(changed) + ' changed'
+        return 'package missing from the store'
+
+
+class RunHistory:
+    "Durations of the past runs per (package, distro, version, stage) in <cache-dir>/history.sqlite"
+    schema = '''
+        CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started REAL, command TEXT);
+        CREATE TABLE IF NOT EXISTS stages (run INTEGER, manifest TEXT, package TEXT, distro TEXT, version TEXT,
+                                           stage TEXT, duration REAL, cached INTEGER, status TEXT, size INTEGER);
+        CREATE INDEX IF NOT EXISTS stages_target ON stages (package, distro, version, stage);
+    '''
+    lock = threading.Lock()
+    connection = None
+    run = None
+    # number of previous builds an estimate or a comparison is made of
+    depth = 5
+    # estimated seconds of the targets of this invocation by name, None without history
+    estimates = dict()
+    # progress of the targets of this invocation
+    workers = 1
+    pending = list()
+    running = dict()
+    done = 0
+
+    @staticmethod
+    def connect():
+        if RunHistory.connection is None:
+            RunHistory.connection = sqlite3.connect(Cache.dir() + '/history.sqlite', timeout=30,
+                                                    check_same_thread=False)
+            RunHistory.connection.executescript(RunHistory.schema)
+        return RunHistory.connection
+
+    @staticmethod
+    def record(job):
+        "save the durations of the stages of a finished target, the whole target being the 'total' stage"
+        stages = {'total': job.duration}
+        with Tracer.lock:
+            for span in Tracer.spans:
+                if span['job'] == job.name:
+                    stages[span['name']] = stages.get(span['name'], 0) + span['end'] - span['start']
+        package = Packager().package_final_name(job.distro, job.version, job.manifest)
+        size = os.path.getsize(package) if job.status == 'passed' and os.path.exists(package) else 0
+        try:
+            with RunHistory.lock:
+                db = RunHistory.connect()
+                with db:
+                    if RunHistory.run is None:
+                        RunHistory.run = db.execute('INSERT INTO runs (started, command) VALUES (?, ?)',
+                                                    (time.time(), ' '.join(sys.argv[1:]))).lastrowid
+                    db.executemany('INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   [(RunHistory.run, os.path.realpath(job.path), job.manifest.pkg.package, job.distro,
+                                     job.version, stage, duration, int(job.cached), job.status, size)
+                                    for stage, duration in stages.items()])
+        except sqlite3.Error as exc:
+            logging.debug(f'run history not saved: {exc}')
+
+    @staticmethod
+    def durations(package, distro, version, stage='total', limit=None):
+        "the durations of the builds of a target stage, the latest first, the cached and failed runs excluded"
+        rows = RunHistory.connect().execute(
+            'SELECT duration FROM stages WHERE package = ? AND distro = ? AND version = ? AND stage = ? '
+            'AND cached = 0 AND status = \'passed\' ORDER BY rowid DESC LIMIT ?',
+            (package, distro, version, stage, limit or RunHistory.depth)).fetchall()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def schedule(jobs, workers):
+        "the targets longest first from their past builds, the ones never built first, and log the estimated time"
+        RunHistory.workers = max(1, workers)
+        try:
+            with RunHistory.lock:
+                for job in jobs:
+                    durations = RunHistory.durations(job.manifest.pkg.package, job.distro, job.version)
+                    RunHistory.estimates[job.name] = statistics.median(durations) if durations else None
+        except sqlite3.Error as exc:
+            logging.debug(f'no run history: {exc}')
+        jobs = sorted(jobs, key=lambda job: -math.inf if RunHistory.estimates.get(job.name) is None
+                      else -RunHistory.estimates[job.name])
+        RunHistory.pending = [job.name for job in jobs]
+        if any(RunHistory.estimates.get(job.name) is not None for job in jobs):
+            logging.info(f'{len(jobs)} targets, about {RunHistory.eta():.0f}s' + RunHistory.unknown())
+        return jobs
+
+    @staticmethod
+    def unknown():
+        count = sum(RunHistory.estimates.get(name) is None for name in RunHistory.pending + list(RunHistory.running))
+        return f' ({count} without history)' if count else ''
+
+    @staticmethod
+    def eta():
+        "the remaining wall time, the pending targets going in order to the first free worker"
+        known = [value for value in RunHistory.estimates.values() if value is not None]
+        default = statistics.median(known) if known else 0
+
+        def estimate(name):
+            value = RunHistory.estimates.get(name)
+            return default if value is None else value
+        now = time.monotonic()
+        loads = [max(0, estimate(name) - (now - start)) for name, start in RunHistory.running.items()]
+        loads += [0] * max(0, RunHistory.workers - len(loads))
+        for name in RunHistory.pending:
+            index = loads.index(min(loads))
+            loads[index] += estimate(name)
+        return max(loads)
+
+    @staticmethod
+    def started(job):
+        with RunHistory.lock:
+            if job.name in RunHistory.pending:
+                RunHistory.pending.remove(job.name)
+            RunHistory.running[job.name] = time.monotonic()
+
+    @staticmethod
+    def finished(job):
+        with RunHistory.lock:
+            RunHistory.running.pop(job.name, None)
+            RunHistory.done += 1
+            left = len(RunHistory.pending) + len(RunHistory.running)
+            if left and any(value is not None for value in RunHistory.estimates.values()):
+                logging.info(f'{RunHistory.done}/{RunHistory.done + left} targets done, '
+                             f'about {RunHistory.eta():.0f}s left' + RunHistory.unknown())
+
+    @staticmethod
+    def report(manifests, threshold):
+        "mdpack history: the recent build times of every target, and the targets and stages that slowed down"
+        db = RunHistory.connect()
+        query = 'SELECT DISTINCT package, distro, version FROM stages WHERE stage = \'total\''
+        paths = [os.path.realpath(path) for path in manifests]
+        if paths:
+            query += ' AND manifest IN (' + ', '.join('?' * len(paths)) + ')'
+        targets = db.execute(query + ' ORDER BY package, distro, version', paths).fetchall()
+        if not targets:
+            logging.info('no run recorded yet')
+            return 0
+        rows = [('target', 'builds', 'last', 'median', 'change', 'recent builds')]
+        slowdowns = list()
+        for package, distro, version in targets:
+            durations = RunHistory.durations(package, distro, version, limit=RunHistory.depth + 1)
+            name = f'{distro}-{version}-{package}'
+            if not durations:
+                rows.append((name, '0', '-', '-', '-', '-'))
+                continue
+            last, previous = durations[0], durations[1:]
+            median = statistics.median(previous) if previous else None
+            change = f'{(last - median) / median:+.0%}' if median else '-'
+            rows.append((name, str(len(durations)), f'{last:.1f}s', f'{median:.1f}s' if median else '-', change,
+                         ' '.join(f'{duration:.1f}' for duration in reversed(durations))))
+            if not median or last <= median * (1 + threshold):
+                continue
+            # the stages which slowed down too and account for a tenth of the slowdown at least
+            stages = [row[0] for row in db.execute('SELECT DISTINCT stage FROM stages WHERE package = ? '
+                                                   'AND distro = ? AND version = ? AND stage != \'total\'',
+                                                   (package, distro, version))]
+            found = list()
+            for stage in stages:
+                durations = RunHistory.durations(package, distro, version, stage, RunHistory.depth + 1)
+                if len(durations) < 2:
+                    continue
+                stage_median = statistics.median(durations[1:])
+                growth = durations[0] - stage_median
+                if durations[0] > stage_median * (1 + threshold) and growth >= 0.1 * (last - median):
+                    found.append((growth, (name, stage, f'{stage_median:.1f}s', f'{durations[0]:.1f}s',
+                                           f'{growth:+.1f}s')))
+            slowdowns += [row for growth, row in sorted(found, reverse=True)]
+        print_table(rows)
+        if slowdowns:
+            logging.info('')
+            logging.info(f'slower than the median of the {RunHistory.depth} previous builds by more than '
+                         f'{threshold:.0%}:')
+            print_table([('target', 'stage', 'median', 'last', 'change')] + slowdowns)
+        return 0
+
+
+class BuildResources:
+    "Host cores and memory shared by the build containers running at once"
+    # per container, None for an equal share of the host
+    cpus = None
+    memory = None
+    # build job count and cmake generator forced for every target, else from the manifest
+    jobs = None
+    generator = None
+    # number of build containers running at once
+    concurrency = 1
+
+    @staticmethod
+    def parse_size(text):
+        "bytes of a size like 512M or 4G, plain numbers are bytes"
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+        text = str(text).strip().upper().rstrip('B')
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+
+    @staticmethod
+    def host_cpus():
+        # the cores this process may run on, which a cgroup or taskset may restrict
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
+    @staticmethod
+    def host_memory():
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    @staticmethod
+    def share():
+        "the cores, memory and number of build containers of the docker host of this thread"
+        host = DockerHosts.current()
+        if host is not None:
+            return host.cpus, host.memory, host.slots
+        return BuildResources.host_cpus(), BuildResources.host_memory(), max(1, BuildResources.concurrency)
+
+    @staticmethod
+    def container_cpus():
+        "cores given to a build container, 0 for no limit"
+        cpus, memory, containers = BuildResources.share()
+        if BuildResources.cpus is not None:
+            return min(BuildResources.cpus, cpus)
+        return max(1, cpus // containers)
+
+    @staticmethod
+    def container_memory():
+        "memory limit of a build container in bytes, 0 for no limit"
+        if BuildResources.memory is not None:
+            return BuildResources.memory
+        cpus, memory, containers = BuildResources.share()
+        return memory // containers
+
+    @staticmethod
+    def build_jobs(manifest):
+        "the build job count, the cores of the container unless forced by the command line or the manifest"
+        jobs = BuildResources.jobs or getattr(manifest.app.build, 'jobs', None)
+        # a container without cpu limit may use all the cores of its host
+        cpus = BuildResources.container_cpus() or BuildResources.share()[0]
+        return jobs or max(1, math.ceil(cpus))
+
+    @staticmethod
+    def generator_of(manifest):
+        return BuildResources.generator or getattr(manifest.app.build, 'generator', None) or 'make'
+
+    @staticmethod
+    def limits():
+        return {'cpus': BuildResources.container_cpus(), 'memory': BuildResources.container_memory()}
+
+
+class Job:
+    "A (manifest, distro, version) target"
+
+    def __init__(self, path, distro, version, manifest, name, manifest_dict=None):
+        self.path = path
+        self.distro = distro
+        self.version = version
+        self.manifest = manifest
+        self.manifest_dict = manifest_dict
+        # unique in this invocation, names the shared dir, the container and the log file
+        self.name = name
+        self.image_tag = 'mdp-' + distro + '-' + version
+        self.status = 'pending'
+        self.stage = ''
+        # the package was delivered from the artifact store
+        self.cached = False
+        self.duration = 0.0
+        self.log_path = None
+        self.log = None
+        self.watchers = list()
+        # directory its package is delivered to, None to leave it in its shared dir (mdpack serve)
+        self.output = '.'
+        # its tested package, in the artifact store or in its shared dir
+        self.package = None
+
 
 class Packager:
+    # jobs sharing a distro image must not build it at the same time
+    image_locks = dict()
+    image_locks_guard = threading.Lock()
+
+    def __init__(self, name=None, interactive=True, manifest_path=None, ccache=None, reuse_container=False,
+                 host_deb=False, output='.'):
+        self.name = name
+        # concurrent containers can't share the terminal
+        self.interactive = interactive
+        # the sources are shared by the targets of the same manifest when given
+        self.manifest_path = manifest_path
+        self.mounts = list()
+        # (path, arcname) sent with the shared dir to a docker host of --hosts, which can't mount them
+        self.shipped = list()
+        # max size of the persistent compiler cache, no cache if None
+        self.ccache = ccache
+        # run the build stages with docker exec in one container instead of whole_process.sh
+        self.reuse_container = reuse_container
+        # write the deb packages on the host with DebWriter instead of dpkg-deb in the container
+        self.host_deb = host_deb
+        # directory the packages are delivered to, None to leave them in the shared dir
+        self.output = output
 
     @ staticmethod
     def get_distro_version(distro_version):
@@ -225,13 +2673,33 @@ class Packager:
             return '', ''
         return split[0], split[1]
 
+    # number of output lines kept to be printed when a command fails
+    tail_lines = 40
+    # print the commands output while they run
+    live = False
+    live_lock = threading.Lock()
+
+    @ staticmethod
+    def stream(pipe, output):
+        "copy the lines of a command output to the job log as they come"
+        for line in iter(pipe.readline, b''):
+            output.line(line)
+        pipe.close()
+
     @ staticmethod
     def run(args):
-        result = subprocess.run(args, capture_output=True)
-        if (result.returncode != 0):
-            logging.critical(result.stdout.decode('utf-8'))
+        output = CommandOutput(' '.join(args))
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as exc:
+            logging.critical(f'{args[0]}: {exc}')
             return False
-        logging.debug(result.stdout.decode("utf-8"))
+        stderr = threading.Thread(target=Packager.stream, args=(process.stderr, output))
+        stderr.start()
+        Packager.stream(process.stdout, output)
+        stderr.join()
+        if (process.wait() != 0):
+            return output.failed(process.returncode)
         return True
 
     def package_name(self, manifest):
@@ -250,18 +2718,107 @@ class Packager:
         return distro + '-' + version + '-' + self.package_name(manifest)
 
     def container_name(self, image_tag, manifest):
+        if self.name is not None:
+            return self.name
         return image_tag + '-' + manifest.pkg.package
 
     def container_shared_dir(self, image_tag, manifest):
         return LocalDirectory(self.container_name(image_tag, manifest)).path
 
-    def make_docker_image(self, distro, version, image_tag):
+    def tty(self):
+        "a terminal is given to the container only when mdpack runs in one"
+        return self.interactive and sys.stdin.isatty()
+
+    def image_lock(self, image_tag):
+        with Packager.image_locks_guard:
+            return Packager.image_locks.setdefault(Docker.key(image_tag), threading.Lock())
+
+    @ staticmethod
+    def image_context(distro, version, kind='docker'):
+        "the docker build context path, build args and their hash for a distro build (docker) or test image"
+        dockerfile_path = os.path.dirname(__file__) + '/mdpack/distro/' + distro + '/' + kind
+        build_args = [f'VERSION={version}']
+        if kind == 'test':
+            # the package metadata of the test image is refreshed daily
+            build_args.append('METADATA_DATE=' + time.strftime('%Y%m%d'))
+        return dockerfile_path, build_args, ImageCache.context_hash(dockerfile_path, build_args)
+
+    @ staticmethod
+    def test_image_tag(distro, version):
+        return 'mdp-test-' + distro + '-' + version
+
+    def make_docker_image(self, distro, version, image_tag, force=False, kind='docker'):
         # docker image
-        dockerfile_path = os.path.dirname(__file__) + '/mdpack/distro/' + distro + '/docker'
+        dockerfile_path, build_args, context_hash = Packager.image_context(distro, version, kind)
+
+        with self.image_lock(image_tag):
+            # already built or verified by another target of this invocation
+            if ImageCache.verified.get(Docker.key(image_tag)) == context_hash:
+                return True
+            if not force:
+                if ImageCache.image_hash(image_tag) == context_hash:
+                    logging.info(f'- image cache hit for {image_tag}')
+                    ImageCache.verified[Docker.key(image_tag)] = context_hash
+                    return True
+                logging.info(f'- image cache miss for {image_tag}')
+            else:
+                logging.info(f'- forced rebuild of {image_tag}')
 
-        # TODO --network host to be removed if possible (security)
-        return Packager.run(['docker', 'build', '--network', 'host', '--build-arg',
-                             f'VERSION={version}', '--tag', image_tag, dockerfile_path])
+            # TODO --network host to be removed if possible (security)
+            if not Docker.current().build(dockerfile_path, image_tag, build_args,
+                                          {ImageCache.label: context_hash}, no_cache=force):
+                return False
+            ImageCache.verified[Docker.key(image_tag)] = context_hash
+            return True
+
+    def planned_image_id(self, distro, version, image_tag, manifest):
+        "id of the image a target would be built in, None if it has to be built first"
+        dockerfile_path, build_args, context_hash = Packager.image_context(distro, version)
+        if ImageCache.image_hash(image_tag) != context_hash:
+            return None
+        run_image = image_tag
+        deps = DepsImageCache.deps_list(manifest)
+        if deps:
+            run_image = DepsImageCache.image_tag(image_tag, context_hash,
+                                                 'mdpack/distro/' + distro + '/install_user_deps.sh', deps)
+        return ImageCache.image_id(run_image)
+
+    def make_deps_image(self, distro, version, image_tag, manifest, force=False):
+        "derive an image with the user build deps installed, returns the tag of the image to build in"
+        deps = DepsImageCache.deps_list(manifest)
+        if not deps:
+            return image_tag
+        script = 'mdpack/distro/' + distro + '/install_user_deps.sh'
+        deps_tag = DepsImageCache.image_tag(image_tag, ImageCache.verified.get(Docker.key(image_tag), ''), script,
+                                            deps)
+
+        with self.image_lock(deps_tag):
+            if Docker.key(deps_tag) in ImageCache.verified:
+                return deps_tag
+            if not force and ImageCache.image_hash(deps_tag) is not None:
+                logging.info(f'- deps image cache hit for {deps_tag}')
+                ImageCache.verified[Docker.key(deps_tag)] = deps_tag
+                DepsImageCache.touch(deps_tag)
+                return deps_tag
+            logging.info(f'- deps image cache miss for {deps_tag}')
+
+            context = LocalDirectory(Cache.dir('deps-context') + '/' + deps_tag).path
+            shutil.copy(script, context + '/install_user_deps.sh')
+            with open(context + '/env.sh', 'w') as env:
+                env.write('#!/bin/bash\nexport APP_BUILD_DEPS="' + ' '.join(deps) + '"\n')
+            with open(context + '/Dockerfile', 'w') as dockerfile:
+                dockerfile.write(f'FROM {image_tag}\n'
+                                 'COPY env.sh install_user_deps.sh /app/\n'
+                                 'RUN /bin/bash /app/install_user_deps.sh && rm -rf /app\n')
+
+            # TODO --network host to be removed if possible (security)
+            built = Docker.current().build(context, deps_tag, [], {ImageCache.label: deps_tag})
+            shutil.rmtree(context, ignore_errors=True)
+            if not built:
+                return None
+            ImageCache.verified[Docker.key(deps_tag)] = deps_tag
+            DepsImageCache.touch(deps_tag, max(0, ImageCache.image_size(deps_tag) - ImageCache.image_size(image_tag)))
+            return deps_tag
 
     def export_env(self, env, env_name, manifest_obj, manifest_attr):
         "export a manifest entry as a shell env variable"
@@ -286,8 +2843,47 @@ class Packager:
         self.export_env_list(env, 'APP_BUILD_CMAKE_OPTIONS', manifest.app.build, 'cmake_options')
         self.export_env_list(env, 'APP_BUILD_DEPS', manifest.app.build, 'deps')
         env.append(f'export PKG_FILENAME={self.package_name(manifest)}\n')
+        # the build job count matches the cores given to the container
+        generator = {'make': 'Unix Makefiles', 'ninja': 'Ninja'}[BuildResources.generator_of(manifest)]
+        env.append(f'export MDP_BUILD_JOBS={BuildResources.build_jobs(manifest)}\n'
+                   f'export MDP_CMAKE_GENERATOR="{generator}"\n')
+        if self.ccache is not None:
+            env.append('export MDP_CCACHE=1\n'
+                       'export CCACHE_DIR=/ccache\n'
+                       'export CCACHE_BASEDIR=/app\n'
+                       f'export CCACHE_MAXSIZE={self.ccache}\n'
+                       'export CMAKE_C_COMPILER_LAUNCHER=ccache\n'
+                       'export CMAKE_CXX_COMPILER_LAUNCHER=ccache\n')
         env.close()
 
+    def ccache_dir(self, distro, version, manifest):
+        "the compiler cache persists per distro, version and package"
+        path = Cache.dir('ccache', distro + '-' + version + '-' + manifest.pkg.package)
+        # the build runs as packager in the container
+        os.chmod(path, 0o777)
+        return path
+
+    def ccache_report(self, dest_dir):
+        "log the hits and misses of the last build from the ccache statistics it saved"
+        hits = misses = 0
+        try:
+            with open(dest_dir + '/ccache_stats.txt') as file:
+                for line in file:
+                    fields = line.replace('\t', '  ').split('  ')
+                    fields = [field.strip() for field in fields if field.strip()]
+                    if len(fields) < 2 or not fields[-1].isdigit():
+                        continue
+                    # ccache --print-stats (>= 4.0) or ccache -s (3.x)
+                    if fields[0] in ('direct_cache_hit', 'preprocessed_cache_hit') or fields[0].startswith('cache hit'):
+                        hits += int(fields[-1])
+                    elif fields[0] in ('cache_miss', 'cache miss'):
+                        misses += int(fields[-1])
+        except OSError:
+            return
+        total = hits + misses
+        ratio = f' ({100 * hits / total:.0f}% hits)' if total else ''
+        logging.info(f'- ccache: {hits} hits, {misses} misses{ratio}')
+
     def make_user_deps_script(self, dest_dir, manifest, distro):
         if hasattr(manifest.app.build, 'deps'):
             shutil.copy('mdpack/distro/' + distro + '/install_user_deps.sh',
@@ -302,7 +2898,9 @@ class Packager:
         src_path = 'mdpack/scripts/pkg/' + manifest.pkg.type + '.sh'
         if (os.path.exists(src_path)):
             PkgConfBuilder(manifest, dest_dir)
-            shutil.copy(src_path, dest_dir + '/pkg.sh')
+            # without pkg.sh the pkg stage is skipped in the container
+            if not (self.host_deb and manifest.pkg.type == 'deb'):
+                shutil.copy(src_path, dest_dir + '/pkg.sh')
 
     def make_process_script(self, dest_dir, manifest, distro):
         src_path = 'mdpack/distro/' + distro + '/whole_process.sh'
@@ -321,68 +2919,160 @@ class Packager:
 
             case 'git':
                 LocalDirectory(dest_dir)
+                source = manifest.app.source
 
                 # first check required fields
-                if not hasattr(manifest.app.source, 'url'):
+                if not hasattr(source, 'url'):
                     logging.critical('app.source.url is required for git type')
                     return False
-                if not hasattr(manifest.app.source, 'tag') and not hasattr(manifest.app.source, 'commit'):
+                if not hasattr(source, 'tag') and not hasattr(source, 'commit'):
                     logging.critical('app.source.tag or app.source.commit is required for git type')
                     return False
 
-                # check commit and tag match
-                if hasattr(manifest.app.source, 'tag') and hasattr(manifest.app.source, 'commit'):
-                    if not Packager.run(['git', 'ls-remote', '--tags', manifest.app.source.url, '|', 'grep',
-                                         f'refs/tags/{manifest.app.source.tag}' + '^{}']):
-                        return False
-
-                if hasattr(manifest.app.source, 'tag'):
-                    commit = manifest.app.source.tag
-                elif hasattr(manifest.app.source, 'commit'):
-                    commit = manifest.app.source.commit
-
-                # clone and checkout
-                if not Packager.run(['git', 'clone', '--recurse-submodules', manifest.app.source.url, dest_dir]):
+                mirror, commit = GitMirror.source_commit(source)
+                if mirror is None:
                     return False
 
-                return Packager.run(['git', '-C', dest_dir, 'checkout', commit])
+                # clone and checkout from the local mirror
+                return GitMirror.checkout(source.url, mirror, commit, dest_dir)
+
+            case 'archive':
+                return ArchiveSource.extract(manifest.app.source, dest_dir)
 
         logging.critical(f'source type "{manifest.app.source.type}" is unknown')
         return False
 
-    def build(self, image_tag, distro, version, manifest):
+    def source_view(self, dest_dir, manifest):
+        "extract the sources into dest_dir, from the manifest snapshot when there is one"
+        if self.manifest_path is None:
+            return self.extract_source(dest_dir, manifest)
+        snapshot = SourceSnapshot.get(self.manifest_path, manifest, self.extract_source)
+        if snapshot is None:
+            return False
+        if DockerHosts.current() is not None:
+            # the snapshot goes in the tar stream as is, no view is needed
+            self.shipped.append((snapshot, 'app/src'))
+            return True
+        mode = SourceSnapshot.view(snapshot, dest_dir)
+        if mode == 'bind':
+            LocalDirectory(dest_dir)
+            self.mounts.append(snapshot + ':/app/src:ro')
+        logging.debug(f'sources view of {snapshot}: {mode}')
+        return mode is not None
+
+    def build(self, image_tag, distro, version, manifest, deps_image=None):
         dest_dir = self.container_shared_dir(image_tag, manifest)
 
-        # generate process scripts
-        self.make_env_script(dest_dir, manifest)
-        self.make_user_deps_script(dest_dir, manifest, distro)
-        self.make_build_script(dest_dir, manifest)
-        self.make_pkg_script(dest_dir, manifest)
-        self.make_process_script(dest_dir, manifest, distro)
+        # generate process scripts, the user deps are already installed in deps_image if given
+        with Tracer.span('scripts'):
+            self.make_env_script(dest_dir, manifest)
+            if deps_image is None:
+                self.make_user_deps_script(dest_dir, manifest, distro)
+            self.make_build_script(dest_dir, manifest)
+            self.make_pkg_script(dest_dir, manifest)
+            self.make_process_script(dest_dir, manifest, distro)
 
-        if (not self.extract_source(dest_dir + '/src', manifest)):
-            return False
+        with Tracer.span('extract_source'):
+            if (not self.source_view(dest_dir + '/src', manifest)):
+                return False
+
+        if self.ccache is not None:
+            self.mounts.append(self.ccache_dir(distro, version, manifest) + ':/ccache')
 
         # run a docker container, which entry point is '/app/whole_process.sh'
         # TODO should we create unnamed containers instead?
-        subprocess.run(['docker', 'stop', self.container_name(image_tag, manifest)],
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(['docker', 'rm', self.container_name(image_tag, manifest)],
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        # TODO --net=host probably bad for security
-        if not Packager.run(
-            ['docker', 'run', '-it', '--net=host', '--rm', '--name', self.container_name(image_tag, manifest),
-             '-v', dest_dir + ':/app', image_tag, '/bin/bash', '-x', '/app/whole_process.sh']):
+        with Tracer.span('cleanup'):
+            Docker.current().remove_container(self.container_name(image_tag, manifest))
+
+        with Tracer.span('container'):
+            # the rpm files list is made on the host between the build and pkg stages, so in a container kept alive,
+            # and the files are copied to a docker host of --hosts once its container is created
+            if self.reuse_container or manifest.pkg.type == 'rpm' or DockerHosts.current() is not None:
+                ok = self.run_stages(dest_dir, deps_image or image_tag, image_tag, manifest)
+            else:
+                # TODO --net=host probably bad for security
+                ok = Docker.current().run(deps_image or image_tag, ['/bin/bash', '-x', '/app/whole_process.sh'],
+                                          [dest_dir + ':/app'] + self.mounts,
+                                          name=self.container_name(image_tag, manifest), tty=self.tty(),
+                                          limits=BuildResources.limits())
+        Tracer.add_container_timings(dest_dir + '/timings.txt')
+        if not ok:
             return False
 
+        if self.ccache is not None:
+            self.ccache_report(dest_dir)
+
+        if self.host_deb and manifest.pkg.type == 'deb':
+            with Tracer.span('deb_writer'):
+                if not DebWriter.write(dest_dir + '/install', dest_dir + '/' + self.package_name(manifest)):
+                    return False
+
         # deliver the generated package near the current script
-        if os.path.exists(dest_dir + '/' + self.package_name(manifest)):
-            shutil.copyfile(dest_dir + '/' + self.package_name(manifest),
-                            dest_dir + '/../' + self.package_final_name(distro, version, manifest))
+        with Tracer.span('deliver'):
+            if self.output is not None and os.path.exists(dest_dir + '/' + self.package_name(manifest)):
+                self.deliver(dest_dir + '/' + self.package_name(manifest),
+                             os.path.join(self.output, self.package_final_name(distro, version, manifest)))
 
         return True
 
+    def run_stages(self, dest_dir, run_image, image_tag, manifest):
+        "run the stages of whole_process.sh with docker exec in a single long-lived container"
+        name = self.container_name(image_tag, manifest)
+        docker = Docker.current()
+        # a docker host of --hosts gets /app as a tar stream and the outputs are copied back
+        shipping = DockerHosts.current() is not None
+        binds = self.mounts if shipping else [dest_dir + ':/app'] + self.mounts
+        # TODO --net=host probably bad for security
+        if not docker.start(run_image, ['sleep', 'infinity'], name, binds, limits=BuildResources.limits()):
+            return False
+        stages = [('user_deps', 'root', 'install_user_deps.sh'), ('build', 'packager', 'build.sh'),
+                  ('postinstall', 'packager', 'postinstall.sh'), ('pkg', 'packager', 'pkg.sh')]
+        try:
+            if shipping:
+                with Tracer.span('ship'):
+                    if not docker.copy_to(name, [(dest_dir, 'app')] + self.shipped):
+                        return False
+                    # the copied files belong to root, the stages run as packager
+                    if not docker.exec(name, ['chown', '-R', 'packager', '/app'], 'root'):
+                        return False
+            for stage, user, script in stages:
+                if not os.path.exists(dest_dir + '/' + script):
+                    continue
+                if stage == 'pkg' and manifest.pkg.type == 'rpm':
+                    with Tracer.span('files_list'):
+                        if shipping and not docker.copy_from(name, '/app/install', dest_dir):
+                            return False
+                        base_paths = ImagePaths.get(run_image)
+                        if base_paths is None:
+                            return False
+                        count = PkgConfBuilder.files_list(dest_dir, base_paths)
+                        if shipping and not docker.copy_to(name, [(dest_dir + '/rpmbuild/files_list',
+                                                                   'app/rpmbuild/files_list')]):
+                            return False
+                    logging.debug(f'{count} entries in the rpm files list')
+                with Tracer.span('container/' + stage):
+                    if not docker.exec(name, ['/bin/bash', '-x', '/app/' + script], user):
+                        return False
+            if shipping:
+                with Tracer.span('fetch'):
+                    if os.path.exists(dest_dir + '/pkg.sh'):
+                        outputs = ['/app/' + self.package_name(manifest)]
+                    else:
+                        # written by DebWriter
+                        outputs = ['/app/install']
+                    for output in outputs:
+                        if not docker.copy_from(name, output, dest_dir):
+                            return False
+            return True
+        finally:
+            docker.remove_container(name)
+
+    def deliver(self, src, dest):
+        "copy the package under a temporary name then rename it, so that concurrent jobs never see a partial file"
+        tmp = f'{dest}.{threading.get_ident()}.tmp'
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+
     def test(self, image_tag, distro, version, manifest):
         dest_dir = LocalDirectory(self.container_name(image_tag, manifest), clear_if_exist=False).path
 
@@ -390,10 +3080,31 @@ class Packager:
         self.make_env_script(dest_dir, manifest)
         self.make_test_script(dest_dir, manifest, distro)
 
+        # the test image is the raw distro image with its package metadata already refreshed
+        test_image = Packager.test_image_tag(distro, version)
+        if not self.make_docker_image(distro, version, test_image, kind='test'):
+            test_image = distro + ':' + version
+
+        if DockerHosts.current() is not None:
+            return self.run_shipped_test(test_image, dest_dir, manifest)
+
         # TODO --net=host probably bad for security
-        return Packager.run(
-            ['docker', 'run', '-it', '--net=host', '--rm', '-v', dest_dir + ':/app', distro + ':' + version,
-             '/bin/bash', '-x', '/app/test.sh'])
+        return Docker.current().run(test_image, ['/bin/bash', '-x', '/app/test.sh'], [dest_dir + ':/app'],
+                                    tty=self.tty())
+
+    def run_shipped_test(self, test_image, dest_dir, manifest):
+        "test on a docker host of --hosts, the package and the test scripts are copied to its container"
+        name = self.name + '-test' if self.name else test_image + '-' + manifest.pkg.package
+        docker = Docker.current()
+        docker.remove_container(name)
+        if not docker.start(test_image, ['sleep', 'infinity'], name, []):
+            return False
+        try:
+            entries = [(dest_dir + '/' + file, 'app/' + file)
+                       for file in ('env.sh', 'test.sh', self.package_name(manifest))]
+            return docker.copy_to(name, entries) and docker.exec(name, ['/bin/bash', '-x', '/app/test.sh'], 'root')
+        finally:
+            docker.remove_container(name)
 
 
 class Options():
@@ -401,63 +3112,561 @@ class Options():
     @ staticmethod
     def parse():
         # -h option is provided by default
-        parser = argparse.ArgumentParser()
-        parser.add_argument('manifests', metavar='manifest_file', type=str, nargs='+', help='manifest files')
+        # mdpack.py serve [options], mdpack.py submit [options] manifest_file...,
+        # mdpack.py history [options] [manifest_file...]
+        command = sys.argv[1] if sys.argv[1:2] in (['serve'], ['submit'], ['history']) else None
+        parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + (' ' + command if command else ''))
+        parser.add_argument('manifests', metavar='manifest_file', type=str,
+                            nargs='*' if command in ('serve', 'history') else '+', help='manifest files')
         parser.add_argument('-v', '--verbose', action='store_true', help='increase verbosity')
-        Options.args = parser.parse_args()
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of (manifest, distro, version) targets processed at once')
+        parser.add_argument('-f', '--force', action='store_true',
+                            help='rebuild the docker images even if their context didn\'t change')
+        parser.add_argument('--build-jobs', type=int,
+                            help='build job count of every target, default is app.build.jobs or the container cores')
+        parser.add_argument('--generator', choices=['make', 'ninja'],
+                            help='cmake generator of every target, default is app.build.generator or make')
+        parser.add_argument('--cpus', type=float,
+                            help='cores given to each build container, 0 for no limit, '
+                                 'default is an equal share of the host cores')
+        parser.add_argument('--memory', type=BuildResources.parse_size,
+                            help='memory limit of each build container (512M, 4G), 0 for none, '
+                                 'default is an equal share of the host memory')
+        parser.add_argument('--no-deps-image', action='store_true',
+                            help='install the user build deps in the build container instead of a cached image')
+        parser.add_argument('--deps-cache-size', type=float, default=20,
+                            help='size limit of the cached deps images in GB, least recently used are removed first')
+        parser.add_argument('--git-cache-size', type=float, default=5,
+                            help='size limit of the git mirrors cache in GB, least recently used are removed first')
+        parser.add_argument('--source-view', choices=['auto', 'copy', 'bind'], default='auto',
+                            help='how the targets share the sources: reflink or hardlink when possible (auto), '
+                                 'full copy, or read-only bind mount')
+        parser.add_argument('--stats', action='store_true', help='print the bytes copied and saved for the sources')
+        parser.add_argument('--ccache', action='store_true',
+                            help='keep a persistent ccache per distro, version and package for cmake builds')
+        parser.add_argument('--ccache-size', type=str, default='5G', help='max size of each ccache, default is 5G')
+        parser.add_argument('--trace', type=str, metavar='FILE',
+                            help='save the stages timings in Chrome trace-event format (chrome://tracing, Perfetto)')
+        parser.add_argument('--timings', action='store_true', help='print the stages timings summary')
+        parser.add_argument('--docker', choices=['auto', 'api', 'cli'], default='auto',
+                            help='drive docker through its Engine API socket ($DOCKER_HOST or /var/run/docker.sock), '
+                                 'or its command line, auto uses the API when it answers')
+        parser.add_argument('--hosts', type=str, metavar='ENDPOINT[=SLOTS],...',
+                            help='docker hosts the targets are spread over (unix:///path, tcp://host:port or a socket '
+                                 'path), each running SLOTS targets at once, default is an equal share of -j')
+        parser.add_argument('--reuse-container', action='store_true',
+                            help='run the build stages with docker exec in a single long-lived container')
+        parser.add_argument('--deb-writer', choices=['container', 'host'], default='container',
+                            help='write the deb packages with dpkg-deb in the build container, '
+                                 'or on the host with multithreaded compression')
+        parser.add_argument('--deb-compression', choices=['xz', 'zstd'], default='xz',
+                            help='compression of the deb packages written on the host')
+        parser.add_argument('--deb-level', type=int, help='compression level of the deb packages written on the host')
+        parser.add_argument('--repo', action='store_true',
+                            help='keep an apt or yum repository of the delivered packages per distro version in '
+                                 'repo/<distro>-<version>')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='build every target even if its package is in the artifact store')
+        parser.add_argument('--plan', action='store_true', help='show which targets would be built and why, then exit')
+        parser.add_argument('--archive-cache-size', type=float, default=5,
+                            help='size limit of the downloaded archives cache in GB, least recently used are '
+                                 'removed first')
+        parser.add_argument('--cache-dir', type=str, default=Cache.root, help='mdpack persistent cache directory')
+        parser.add_argument('--log-dir', type=str, default='mdpack-logs', help='directory of the per-target log files')
+        parser.add_argument('--tail', type=int, default=40,
+                            help='number of output lines printed when a command fails, default is 40')
+        parser.add_argument('--socket', type=str,
+                            help='unix socket of mdpack serve, default is <cache-dir>/serve.sock')
+        parser.add_argument('--http', type=str, metavar='HOST:PORT',
+                            help='mdpack serve also listens on HTTP, mdpack submit connects to it')
+        parser.add_argument('--image-jobs', type=int, default=2,
+                            help='number of targets mdpack serve runs at once per distro image')
+        parser.add_argument('--last', type=int, default=5,
+                            help='number of previous builds the estimates and mdpack history are made of, default is 5')
+        parser.add_argument('--slowdown', type=float, default=0.2,
+                            help='mdpack history shows the targets slower than their previous builds by more than '
+                                 'this fraction, default is 0.2')
+        Options.args = parser.parse_args(sys.argv[2:] if command else sys.argv[1:])
+        Options.args.command = command
+
+
+def make_jobs(paths, resolver=None, names=None):
+    "resolve the manifests into the list of targets to process, None if a manifest is invalid"
+    resolver = resolver or ManifestResolver()
+    jobs = list()
+    # the names already in use, by the jobs in flight in mdpack serve
+    names = set() if names is None else names
+    for path in paths:
+
+        for distro, version in resolver.targets(path):
 
+            # complete manifest with distro fields then replace default entries by distro entries
+            distro_dict = resolver.resolve(path, distro, version)
+            if distro_dict is None or not Manifest.check_required_fields(distro_dict):
+                logging.critical(f'Please correct the file {path}')
+                for job in jobs:
+                    names.discard(job.name)
+                return None
 
-def main():
+            manifest = Manifest(distro_dict)
 
-    Options.parse()
-    if Options.args.verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
+            # the same package may be delivered by several manifests for the same distro
+            name = 'mdp-' + distro + '-' + version + '-' + manifest.pkg.package
+            unique, index = name, 1
+            while unique in names:
+                index += 1
+                unique = f'{name}-{index}'
+            names.add(unique)
+            jobs.append(Job(path, distro, version, manifest, unique, distro_dict))
+    return jobs
+
+
+def run_job(job):
+    "build, package and test one target, the job status tells where it stopped"
+    JobLog.begin(job, Options.args.log_dir)
+    start = time.monotonic()
+    distro, version, manifest, image_tag = job.distro, job.version, job.manifest, job.image_tag
+    # with --hosts the target waits for a slot on one of the docker hosts
+    host = DockerHosts.place(job) if DockerHosts.hosts else None
+    # the compiler cache is a bind mount, it is only on the local docker host
+    pak = Packager(job.name, interactive=Options.args.jobs <= 1, manifest_path=job.path,
+                   ccache=Options.args.ccache_size if Options.args.ccache and host is None else None,
+                   reuse_container=Options.args.reuse_container, host_deb=Options.args.deb_writer == 'host',
+                   output=job.output)
+    job.status = 'failed'
+    try:
+        if host is not None:
+            logging.info(f'- placed on {host.endpoint}')
+        # 1. build docker image
+        logging.info('Processing ' + distro + '-' + version)
+        logging.info('- building docker image ' + distro + '-' + version)
+        job.stage = 'image'
+        with Tracer.span('image'):
+            ok = pak.make_docker_image(distro=distro, version=version, image_tag=image_tag,
+                                       force=Options.args.force)
+        if not ok:
+            logging.critical('FAILED, is docker running on your host?')
+            return False
 
-    for path in Options.args.manifests:
+        deps_image = None
+        if not Options.args.no_deps_image:
+            logging.info('- building user deps image ' + distro + '-' + version)
+            job.stage = 'deps'
+            with Tracer.span('deps_image'):
+                deps_image = pak.make_deps_image(distro=distro, version=version, image_tag=image_tag,
+                                                 manifest=manifest, force=Options.args.force)
+            if deps_image is None:
+                logging.critical('FAILED')
+                return False
+
+        # an unchanged target is delivered from the artifact store
+        with Tracer.span('inputs'):
+            inputs = ArtifactStore.inputs(job, ImageCache.image_id(deps_image or image_tag))
+        final_name = pak.package_final_name(distro, version, manifest)
+        if ArtifactStore.complete(inputs) and not Options.args.no_cache:
+            cached = ArtifactStore.lookup(inputs)
+            if cached is not None:
+                logging.info('- artifact cache hit, delivering ' + final_name)
+                if job.output is not None:
+                    with Tracer.span('deliver'):
+                        pak.deliver(cached, os.path.join(job.output, final_name))
+                job.package = cached
+                job.cached = True
+                job.stage = ''
+                job.status = 'passed'
+                return True
+
+        # 2. build the sources and package them
+        logging.info('- building ' + pak.package_name(manifest))
+        job.stage = 'build'
+        if (not pak.build(image_tag=image_tag, distro=distro, version=version, manifest=manifest,
+                          deps_image=deps_image)):
+            logging.critical('FAILED')
+            return False
 
-        pak = Packager()
-        user_manifest = AddingYaml(path)
-        if not user_manifest.dict:
-            continue
+        # 3. test the package installation
+        logging.info('- testing ' + pak.package_final_name(distro, version, manifest))
+        job.stage = 'test'
+        with Tracer.span('test'):
+            ok = pak.test(image_tag=image_tag, distro=distro, version=version, manifest=manifest)
+        if not ok:
+            logging.critical('FAILED')
+            return False
 
-        for distro_version in user_manifest.dict['distro']:
+        package = os.path.realpath(os.path.join(pak.container_name(image_tag, manifest), pak.package_name(manifest)))
+        if os.path.exists(package):
+            job.package = package
+            if ArtifactStore.complete(inputs):
+                job.package = ArtifactStore.store(job, inputs, package, final_name)
 
-            distro, version = pak.get_distro_version(distro_version)
-            if not distro:
-                continue
+        job.stage = ''
+        job.status = 'passed'
+        return True
+    except Exception as exc:
+        logging.critical(f'FAILED, {exc!r}')
+        return False
+    finally:
+        if host is not None:
+            DockerHosts.release(host)
+        job.duration = time.monotonic() - start
+        RunHistory.record(job)
+        JobLog.end(job)
+
+
+def build_images(jobs):
+    "build every image needed by the targets once, returns the targets whose image is ready grouped by image"
+    images = dict()
+    for job in jobs:
+        images.setdefault(job.image_tag, (job.distro, job.version))
+    pak = Packager(interactive=Options.args.jobs <= 1)
+
+    def build(item):
+        image_tag, (distro, version) = item
+        # the images are built outside of the targets, in their own log file
+        JobLog.begin(Job('', distro, version, None, image_tag), Options.args.log_dir + '/images')
+        try:
+            logging.info('Building docker image ' + image_tag)
+            with Tracer.span('image', image=image_tag):
+                ok = pak.make_docker_image(distro=distro, version=version, image_tag=image_tag,
+                                           force=Options.args.force)
+            if not ok:
+                return image_tag, False
+            # a test image failure isn't fatal, the raw distro image is used instead
+            with Tracer.span('test_image', image=image_tag):
+                pak.make_docker_image(distro=distro, version=version,
+                                      image_tag=Packager.test_image_tag(distro, version), force=Options.args.force,
+                                      kind='test')
+            return image_tag, ok
+        finally:
+            JobLog.end(JobLog.current.job)
+
+    with ThreadPoolExecutor(max_workers=max(1, Options.args.jobs)) as pool:
+        ready = dict(pool.map(build, images.items()))
+
+    failed = [image_tag for image_tag, ok in ready.items() if not ok]
+    if failed:
+        logging.critical('FAILED to build ' + ', '.join(failed) + ', is docker running on your host?')
+    for job in jobs:
+        if not ready[job.image_tag]:
+            job.status = 'failed'
+            job.stage = 'image'
+    return sorted((job for job in jobs if ready[job.image_tag]), key=lambda job: list(images).index(job.image_tag))
+
+
+def update_repositories(output_dir, jobs):
+    "add the packages of the passed targets to the repositories of output_dir"
+    packages = [(job.distro, job.version, Packager().package_final_name(job.distro, job.version, job.manifest))
+                for job in jobs if job.status == 'passed']
+    packages = [package for package in packages if os.path.exists(os.path.join(output_dir, package[2]))]
+    if packages:
+        with Tracer.span('repo_index'):
+            RepositoryIndex.update(output_dir, packages)
+
+
+def print_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        logging.info('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def summary_row(job):
+    status = job.status + (' (cached)' if job.cached else '')
+    return (job.name, job.path, status, job.stage or '-', f'{job.duration:.1f}s')
+
+
+def print_summary(jobs):
+    logging.info('')
+    print_table([('target', 'manifest', 'result', 'stage', 'time')] + [summary_row(job) for job in jobs])
+
+
+def print_plan(jobs):
+    "show which targets would be built and why, without building anything"
+    rows = [('target', 'manifest', 'action', 'reason')]
+    for job in jobs:
+        pak = Packager(job.name)
+        image_id = pak.planned_image_id(job.distro, job.version, job.image_tag, job.manifest)
+        inputs = ArtifactStore.inputs(job, image_id, dry_run=True)
+        reason = '--no-cache' if Options.args.no_cache else ArtifactStore.why(job, inputs)
+        rows.append((job.name, job.path, 'build' if reason else 'cached', reason or '-'))
+    print_table(rows)
+
+
+class Server:
+    "mdpack serve: run the submitted manifests, keeping the resolved manifests and the images state warm"
+
+    def __init__(self):
+        self.resolver = ManifestResolver()
+        # names of the jobs in flight, so that concurrent submissions never share a container or a directory
+        self.names = set()
+        # identical targets in flight, run once for all their submissions
+        self.inflight = dict()
+        # submissions of each job name, its shared dir is kept until they all have their package
+        self.holders = collections.Counter()
+        self.image_slots = dict()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, Options.args.jobs))
 
-            # complete manifest with distro fields then replace default entries by distro entries
-            distro_yaml = 'mdpack/distro/' + distro + '/' + distro + '.yaml'
-            distro_dict = (AddingYaml(path) + AddingYaml(distro_yaml)).dict
-            Manifest.add_defaults(distro_dict, distro, version)
-            Manifest.substitute_defaults(distro_dict, distro, version)
-            if not Manifest.check_required_fields(distro_dict):
-                logging.critical(f'Please correct the file {path}')
-                os._exit(1)
+    @staticmethod
+    def job_key(job):
+        manifest = json.dumps(job.manifest_dict, sort_keys=True, default=str)
+        return hashlib.sha256(f'{os.path.realpath(job.path)}\0{job.distro}\0{job.version}\0{manifest}'.encode()) \
+            .hexdigest()
 
-            manifest = Manifest(distro_dict)
+    async def run(self, job, key):
+        loop = asyncio.get_running_loop()
+        try:
+            # with --hosts the images are built on the hosts the targets are placed on
+            if DockerHosts.hosts or await loop.run_in_executor(self.pool, build_images, [job]):
+                slots = self.image_slots.setdefault(job.image_tag, asyncio.Semaphore(Options.args.image_jobs))
+                async with slots:
+                    await loop.run_in_executor(self.pool, run_job, job)
+        finally:
+            del self.inflight[key]
+            # the dir sources and the images may change before the next submission
+            if not self.inflight:
+                SourceSnapshot.clear()
+                Fingerprint.memo.clear()
+                ImageCache.verified.clear()
+                Tracer.spans.clear()
+
+    async def submit(self, manifests, output, send):
+        "run the targets of the manifests, their log and results are given to send, returns the exit status"
+        loop = asyncio.get_running_loop()
+        # resolved in the event loop, so that the names of concurrent submissions can't collide
+        jobs = make_jobs(manifests, self.resolver, self.names)
+        if jobs is None:
+            send({'log': 'invalid manifest in ' + ' '.join(manifests) + '\n'})
+            return 1
+
+        queue = asyncio.Queue()
+        targets = list()
+        for job in jobs:
+            key = Server.job_key(job)
+            if key in self.inflight:
+                self.names.discard(job.name)
+                job, task = self.inflight[key]
+                send({'target': job.name, 'log': 'attached to the same target in flight\n'})
+            else:
+                # the package is delivered to each submission from the job, never through the daemon directory
+                job.output = None
+                task = asyncio.ensure_future(self.run(job, key))
+                self.inflight[key] = (job, task)
+            self.holders[job.name] += 1
+
+            def watcher(data, name=job.name):
+                loop.call_soon_threadsafe(queue.put_nowait, (name, data))
+            job.watchers.append(watcher)
+            targets.append((job, task, watcher))
+
+        # the log written by a job is queued before its task ends
+        done = asyncio.gather(*(task for job, task, watcher in targets), return_exceptions=True)
+        done.add_done_callback(lambda _: queue.put_nowait(None))
+        while (item := await queue.get()) is not None:
+            send({'target': item[0], 'log': item[1].decode('utf-8', errors='replace')})
+
+        for job, task, watcher in targets:
+            job.watchers.remove(watcher)
+            final_name = Packager().package_final_name(job.distro, job.version, job.manifest)
+            if job.status == 'passed' and job.package is not None:
+                await loop.run_in_executor(None, Packager().deliver, job.package, os.path.join(output, final_name))
+            self.holders[job.name] -= 1
+            if not self.holders[job.name]:
+                del self.holders[job.name]
+                self.names.discard(job.name)
+            if job.stage == 'image':
+                send({'target': job.name, 'log': f'{job.image_tag} can\'t be built, see the mdpack serve log\n'})
+            send({'result': summary_row(job)})
+        if Options.args.repo:
+            await loop.run_in_executor(None, update_repositories, output, [job for job, task, watcher in targets])
+        return 0 if all(job.status == 'passed' for job, task, watcher in targets) else 1
+
+    async def connection(self, reader, writer):
+        "one request per connection: POST /jobs streams json lines back, GET /status lists the targets in flight"
+        try:
+            method, target, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = dict()
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        except (ValueError, EOFError, ConnectionError):
+            writer.close()
+            return
+
+        def send(message):
+            data = json.dumps(message).encode() + b'\n'
+            writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
 
-            # 1. build docker image
-            logging.info('Processing ' + distro + '-' + version)
-            logging.info('- building docker image ' + distro + '-' + version)
-            image_tag = 'mdp-' + distro + '-' + version
-            if (not pak.make_docker_image(distro=distro,
-                                          version=version,
-                                          image_tag=image_tag)):
-                logging.critical('FAILED, is docker running on your host?')
-                continue
+        try:
+            if method == 'POST' and target == '/jobs':
+                request = json.loads(body)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                             b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+                status = await self.submit(request['manifests'], request.get('output', os.getcwd()), send)
+                send({'status': status})
+                writer.write(b'0\r\n\r\n')
+            elif method == 'GET' and target == '/status':
+                data = json.dumps([{'target': job.name, 'status': job.status, 'stage': job.stage}
+                                   for job, task in self.inflight.values()]).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n'
+                             + f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+            else:
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+        except ConnectionError:
+            # the client is gone, its targets still run for the other submissions and the artifact store
+            pass
+        finally:
+            writer.close()
+
+    def serve(self):
+        socket_path = Options.args.socket or Cache.dir() + '/serve.sock'
+
+        async def main():
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            servers = [await asyncio.start_unix_server(self.connection, socket_path)]
+            logging.info(f'mdpack serving on {socket_path}')
+            if Options.args.http:
+                host, _, port = Options.args.http.rpartition(':')
+                servers.append(await asyncio.start_server(self.connection, host or 'localhost', int(port)))
+                logging.info(f'mdpack serving on http://{host or "localhost"}:{port}')
+            stop = asyncio.Event()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+            await stop.wait()
+            for server in servers:
+                server.close()
+            os.remove(socket_path)
+            logging.info('mdpack serve stopped')
+
+        JobFormatter.prefix = True
+        asyncio.run(main())
+
+
+def submit():
+    "mdpack submit: run the manifests with mdpack serve, printing their log as it comes, returns the exit status"
+    if Options.args.http:
+        host, _, port = Options.args.http.rpartition(':')
+        client = HttpClient(host=host or 'localhost', port=int(port))
+    else:
+        client = HttpClient(socket_path=Options.args.socket or Cache.dir() + '/serve.sock')
+    request = {'manifests': [os.path.abspath(path) for path in Options.args.manifests], 'output': os.getcwd()}
+    rows = [('target', 'manifest', 'result', 'stage', 'time')]
+    status = [1]
+    partial = [b'']
+
+    def messages(data):
+        lines = (partial[0] + data).split(b'\n')
+        partial[0] = lines.pop()
+        for message in (json.loads(line) for line in lines if line.strip()):
+            if 'log' in message:
+                prefix = f'[{message["target"]}] ' if 'target' in message else ''
+                for line in message['log'].splitlines():
+                    print(prefix + line)
+            elif 'result' in message:
+                rows.append(tuple(message['result']))
+            elif 'status' in message:
+                status[0] = message['status']
+
+    try:
+        asyncio.run(client.request('POST', '/jobs', body=request, sink=messages))
+    except (OSError, EOFError) as exc:
+        logging.critical(f'mdpack serve doesn\'t answer: {exc}')
+        return 1
+    if len(rows) > 1:
+        logging.info('')
+        print_table(rows)
+    return status[0]
 
-            # 2. build the sources and package them
-            logging.info('- building ' + pak.package_name(manifest))
-            if (not pak.build(image_tag=image_tag, distro=distro, version=version, manifest=manifest)):
-                logging.critical('FAILED')
-                continue
 
-            # 3. test the package installation
-            logging.info('- testing ' + pak.package_final_name(distro, version, manifest))
-            if (not pak.test(image_tag=image_tag, distro=distro, version=version, manifest=manifest)):
-                logging.critical('FAILED')
-                continue
+def main():
+
+    Options.parse()
+    Packager.live = Options.args.verbose
+    Packager.tail_lines = Options.args.tail
+    Cache.root = Options.args.cache_dir
+    RunHistory.depth = max(1, Options.args.last)
+    DepsImageCache.max_size = Options.args.deps_cache_size * 1024 ** 3
+    GitMirror.max_size = Options.args.git_cache_size * 1024 ** 3
+    ArchiveSource.max_size = Options.args.archive_cache_size * 1024 ** 3
+    SourceSnapshot.mode = Options.args.source_view
+    DebWriter.compression = Options.args.deb_compression
+    DebWriter.level = Options.args.deb_level
+    BuildResources.jobs = Options.args.build_jobs
+    BuildResources.generator = Options.args.generator
+    BuildResources.cpus = Options.args.cpus
+    BuildResources.memory = Options.args.memory
+    BuildResources.concurrency = max(1, Options.args.jobs)
+
+    # the root logger lets everything through to the job log files, the console keeps its own level
+    root = logging.getLogger()
+    console = root.handlers[0]
+    console.setFormatter(JobFormatter('%(message)s'))
+    console.setLevel(logging.DEBUG if Options.args.verbose else logging.INFO)
+    job_log = JobLog()
+    job_log.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    root.addHandler(job_log)
+    root.setLevel(logging.DEBUG)
+
+    if Options.args.command == 'submit':
+        sys.exit(submit())
+    if Options.args.command == 'history':
+        sys.exit(RunHistory.report(Options.args.manifests, Options.args.slowdown))
+
+    if Options.args.hosts:
+        if not DockerHosts.connect(Options.args.hosts, Options.args.docker, Options.args.jobs):
+            sys.exit(1)
+        Docker.backend = DockerHosts.hosts[0].backend
+    elif not Docker.select(Options.args.docker):
+        sys.exit(1)
+    logging.debug(f'docker backend: {Docker.backend.name}')
+
+    if Options.args.command == 'serve':
+        Server().serve()
+        return
+
+    jobs = make_jobs(Options.args.manifests)
+    if jobs is None:
+        os._exit(1)
+
+    if Options.args.plan:
+        print_plan(jobs)
+        return
+
+    # each image is built once, then the targets are dispatched,
+    # with --hosts the images are built on the hosts the targets are placed on
+    ready = jobs if DockerHosts.hosts else build_images(jobs)
+    # the host is shared by the build containers running at once
+    BuildResources.concurrency = max(1, min(Options.args.jobs, len(ready)))
+    # the longest targets first, so that the last one to finish isn't a long one started late
+    ready = RunHistory.schedule(ready, Options.args.jobs)
+
+    def run(job):
+        RunHistory.started(job)
+        run_job(job)
+        RunHistory.finished(job)
+
+    if Options.args.jobs > 1:
+        JobFormatter.prefix = True
+        with ThreadPoolExecutor(max_workers=Options.args.jobs) as pool:
+            list(pool.map(run, ready))
+    else:
+        for job in ready:
+            run(job)
+
+    SourceSnapshot.clear()
+    if Options.args.repo:
+        update_repositories(os.getcwd(), jobs)
+    print_summary(jobs)
+    if Options.args.stats:
+        SourceSnapshot.report()
+    if Options.args.timings:
+        Tracer.summary()
+    if Options.args.trace:
+        Tracer.export(Options.args.trace)
+    if any(job.status != 'passed' for job in jobs):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -4,4 +4,4 @@
 #ln -snf /usr/share/zoneinfo/$TZ /etc/localtime && echo $TZ > /etc/timezone
 
 apt-get update
-apt-get install -y --no-install-recommends build-essential g++ cmake tree
+apt-get install -y --no-install-recommends build-essential g++ cmake ninja-build ccache tree
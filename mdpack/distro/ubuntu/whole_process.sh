@@ -1,6 +1,16 @@
 #!/bin/bash
 chmod +x /app/*.sh
-[ -f /app/install_user_deps.sh ] && /app/install_user_deps.sh
-su -c /app/build.sh packager
-[ -f /app/postinstall.sh ] && su -c /app/postinstall.sh packager
-su -c /app/pkg.sh packager
+# each stage appends '<stage> <start> <end> <status>' to /app/timings.txt for mdpack --trace and --timings
+stage() {
+    local name=$1 start=$(date +%s.%N)
+    shift
+    "$@"
+    local status=$?
+    echo "${name} ${start} $(date +%s.%N) ${status}" >> /app/timings.txt
+    return ${status}
+}
+[ -f /app/install_user_deps.sh ] && stage user_deps /app/install_user_deps.sh
+stage build su -c /app/build.sh packager || exit
+if [ -f /app/postinstall.sh ]; then stage postinstall su -c /app/postinstall.sh packager || exit; fi
+# no pkg.sh when mdpack writes the package on the host
+if [ -f /app/pkg.sh ]; then stage pkg su -c /app/pkg.sh packager; fi
@@ -1,5 +1,14 @@
 #!/bin/bash
 source /app/env.sh
 mkdir /app/install
-cmake ${APP_BUILD_CMAKE_OPTIONS} -DCMAKE_INSTALL_PREFIX=/app/install -B /app/build /app/src
-make -C /app/build && make -C /app/build install
+[ -n "${MDP_CCACHE}" ] && ccache -z
+# MDP_BUILD_JOBS matches the cores given to the container, it's given to make or ninja with -j because
+# cmake --build --parallel needs cmake 3.12
+cmake -G "${MDP_CMAKE_GENERATOR:-Unix Makefiles}" ${APP_BUILD_CMAKE_OPTIONS} -DCMAKE_INSTALL_PREFIX=/app/install \
+    ${CMAKE_C_COMPILER_LAUNCHER:+-DCMAKE_C_COMPILER_LAUNCHER=${CMAKE_C_COMPILER_LAUNCHER}} \
+    ${CMAKE_CXX_COMPILER_LAUNCHER:+-DCMAKE_CXX_COMPILER_LAUNCHER=${CMAKE_CXX_COMPILER_LAUNCHER}} \
+    -B /app/build /app/src
+cmake --build /app/build -- -j ${MDP_BUILD_JOBS:-1} && cmake --build /app/build --target install
+status=$?
+[ -n "${MDP_CCACHE}" ] && { ccache --print-stats 2>/dev/null || ccache -s; } > /app/ccache_stats.txt
+exit ${status}
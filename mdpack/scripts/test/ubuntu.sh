@@ -1,4 +1,5 @@
 #!/bin/bash
 source /app/env.sh
-apt-get update
+# the mdpack test image already has the package metadata
+[ -f /etc/mdpack-test-base ] || apt-get update
 apt-get install -y /app/${PKG_FILENAME}
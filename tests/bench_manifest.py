@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Manifest resolution benchmark
+
+Generates synthetic manifests (packages x distro versions, with distro and distro_version prefixed keys), then
+resolves and validates every target with the former per-target parsing and with ManifestResolver.
+The results of both must be identical, their throughputs are printed and optionally saved as json.
+
+usage: tests/bench_manifest.py [--packages N] [--versions M] [--keys K] [--json out.json]
+"""
+
+import sys
+import os
+import time
+import json
+import tempfile
+import argparse
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mdpack  # noqa: E402
+from cerberus import Validator  # noqa: E402
+
+DISTROS = {'ubuntu': ['18.04', '20.04', '22.04', '22.10', '23.04'],
+           'fedora': ['33', '34', '35', '36', '37']}
+
+
+def synthetic_manifest(index, versions, keys):
+    distro = [f'{d}:{v}' for d, vers in DISTROS.items() for v in vers[:versions]]
+    build = {'type': 'cmake', 'cmake_options': [f'-DOPTION_{index}=ON']}
+    pkg = {'package': f'pkg{index}', 'version': f'1.{index}', 'release': 0, 'license': 'MIT',
+           'summary': 'synthetic package', 'description': 'synthetic package', 'maintainer': 'bench <b@e.nch>'}
+    for key in range(keys):
+        build[f'opt{key}'] = f'value{key}'
+        for d, vers in DISTROS.items():
+            build[f'{d}_opt{key}'] = f'{d}-value{key}'
+            build[f'{d}_{vers[0]}_opt{key}'] = f'{d}-{vers[0]}-value{key}'
+            pkg[f'{d}_field{key}'] = f'{d}-field{key}'
+    build['ubuntu_deps'] = ['libgmp-dev', 'libmpfr-dev']
+    build['fedora_deps'] = ['mpfr-devel']
+    return {'distro': distro, 'app': {'source': {'type': 'dir', 'path': '/src'}, 'build': build}, 'pkg': pkg}
+
+
+def legacy(paths):
+    "one parse of the manifest for the distro list, then two parses and a new validator per target"
+    results = list()
+    for path in paths:
+        for distro_version in mdpack.AddingYaml(path).dict['distro']:
+            distro, version = mdpack.Packager.get_distro_version(distro_version)
+            distro_yaml = 'mdpack/distro/' + distro + '/' + distro + '.yaml'
+            distro_dict = (mdpack.AddingYaml(path) + mdpack.AddingYaml(distro_yaml)).dict
+            mdpack.Manifest.add_defaults(distro_dict, distro, version)
+            mdpack.Manifest.substitute_defaults(distro_dict, distro, version)
+            assert Validator(mdpack.Manifest.schema, allow_unknown=True).validate(distro_dict)
+            results.append(distro_dict)
+    return results
+
+
+def resolver(paths):
+    results = list()
+    res = mdpack.ManifestResolver()
+    for path in paths:
+        for distro, version in res.targets(path):
+            distro_dict = res.resolve(path, distro, version)
+            assert mdpack.Manifest.check_required_fields(distro_dict)
+            results.append(distro_dict)
+    return results
+
+
+def measure(function, paths, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        results = function(paths)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=200, help='number of manifests')
+    parser.add_argument('--versions', type=int, default=4, help='versions per distro')
+    parser.add_argument('--keys', type=int, default=20, help='overridable keys per manifest')
+    parser.add_argument('--rounds', type=int, default=3, help='best of N rounds')
+    parser.add_argument('--json', type=str, help='save the results in this file')
+    args = parser.parse_args()
+
+    # distro defaults are looked up relatively to the repository root
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = list()
+        for index in range(args.packages):
+            path = f'{tmp}/manifest{index}.yaml'
+            with open(path, 'w') as file:
+                yaml.dump(synthetic_manifest(index, args.versions, args.keys), file)
+            paths.append(path)
+
+        legacy_time, legacy_results = measure(legacy, paths, args.rounds)
+        resolver_time, resolver_results = measure(resolver, paths, args.rounds)
+
+    if legacy_results != resolver_results:
+        print('FAILED: resolver results differ from the legacy resolution')
+        return 1
+
+    targets = len(resolver_results)
+    results = {
+        'targets': targets,
+        'legacy_seconds': legacy_time,
+        'resolver_seconds': resolver_time,
+        'legacy_targets_per_second': targets / legacy_time,
+        'resolver_targets_per_second': targets / resolver_time,
+        'speedup': legacy_time / resolver_time
+    }
+    print(f'{targets} targets ({args.packages} manifests x {2 * args.versions} distro versions)')
+    print(f'legacy:   {legacy_time:.3f}s  {results["legacy_targets_per_second"]:.0f} targets/s')
+    print(f'resolver: {resolver_time:.3f}s  {results["resolver_targets_per_second"]:.0f} targets/s')
+    print(f'speedup:  x{results["speedup"]:.1f}')
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
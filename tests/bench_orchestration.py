@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Orchestration benchmark, offline
+
+Runs mdpack.py over synthetic manifests (manifests x distros x source sizes, dir and git sources) with stub
+docker, git and cp executables on PATH: they record every call, docker simulates the builds and git and cp call
+the real ones, with configurable latencies. Each scenario is run cold (empty cache directory) then warm.
+Measured: wall time, process spawns (docker, git, cp calls), bytes copied for the sources and peak RSS.
+
+The results are printed and optionally saved as json, and compared with a baseline when given: the command fails
+when a scenario spawns more processes or copies more bytes than its baseline, or is slower or uses more memory
+than its baseline beyond --tolerance (the time and memory depend on the host).
+
+usage: tests/bench_orchestration.py [--manifests 1,4] [--distros 1,3] [--sizes 1,8] [--sources dir,git]
+                                    [--docker-latency S] [--git-latency S] [--json out.json]
+                                    [--baseline tests/bench_baseline.json] [--save-baseline]
+"""
+
+import sys
+import os
+import re
+import time
+import json
+import shutil
+import random
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DISTROS = ['ubuntu:22.04', 'fedora:35', 'ubuntu:20.04', 'fedora:36', 'ubuntu:22.10', 'fedora:37']
+METRICS = ['wall_seconds', 'spawns', 'docker_calls', 'git_calls', 'bytes_copied', 'peak_rss_kb']
+
+DOCKER_SHIM = r'''#!/usr/bin/env python3
+import sys, os, re, json, time, fcntl
+args = sys.argv[1:]
+state = os.environ['MDP_BENCH_STATE']
+with open(state + '/calls.log', 'a') as log:
+    log.write('docker ' + ' '.join(args) + '\n')
+time.sleep(float(os.environ.get('MDP_BENCH_DOCKER_LATENCY', '0')))
+
+
+def app_dir(args):
+    for index, arg in enumerate(args[:-1]):
+        if arg == '-v' and args[index + 1].endswith(':/app'):
+            return args[index + 1][:-len(':/app')]
+    return None
+
+
+def install(app):
+    os.makedirs(app + '/install/usr/bin', exist_ok=True)
+    with open(app + '/install/usr/bin/app', 'w') as file:
+        file.write('app\n')
+
+
+def package(app):
+    with open(app + '/env.sh') as env:
+        name = re.search(r'PKG_FILENAME=(\S+)', env.read()).group(1)
+    with open(app + '/' + name, 'w') as file:
+        file.write('package\n')
+
+
+with open(state + '/images.lock', 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    images = json.load(open(state + '/images.json')) if os.path.exists(state + '/images.json') else dict()
+    if args[:2] == ['image', 'inspect']:
+        if args[-1] not in images:
+            sys.exit(1)
+        print(json.dumps([images[args[-1]]]))
+    elif args[0] == 'build':
+        labels = dict(args[i + 1].split('=', 1) for i, arg in enumerate(args) if arg == '--label')
+        tag = args[args.index('--tag') + 1]
+        images[tag] = {'Id': 'sha256:%064x' % (hash(tag + json.dumps(labels)) & (1 << 256) - 1),
+                       'Size': 1 << 20, 'Config': {'Labels': labels}}
+        print('Successfully built')
+    elif args[0] == 'rmi':
+        images.pop(args[-1], None)
+    json.dump(images, open(state + '/images.json', 'w'))
+
+if args[0] == 'run':
+    app = app_dir(args)
+    if 'find' in args:
+        sys.stdout.write('\0'.join(['/', '/usr', '/usr/bin', '/etc']) + '\0')
+    elif '--detach' in args:
+        with open(state + '/container-' + args[args.index('--name') + 1], 'w') as file:
+            file.write(app)
+    elif app is not None and 'whole_process.sh' in ' '.join(args):
+        install(app)
+        if os.path.exists(app + '/pkg.sh'):
+            package(app)
+elif args[0] == 'exec':
+    with open(state + '/container-' + args[3]) as file:
+        app = file.read()
+    if args[-1] == '/app/build.sh':
+        install(app)
+    elif args[-1] == '/app/pkg.sh':
+        package(app)
+'''
+
+PASSTHROUGH_SHIM = r'''#!/usr/bin/env python3
+import sys, os, time
+with open(os.environ['MDP_BENCH_STATE'] + '/calls.log', 'a') as log:
+    log.write('{name} ' + ' '.join(sys.argv[1:]) + '\n')
+if set(sys.argv[1:3]) & {{'clone', 'fetch'}}:
+    time.sleep(float(os.environ.get('MDP_BENCH_GIT_LATENCY', '0')))
+os.execv('{real}', ['{real}'] + sys.argv[1:])
+'''
+
+
+def write_shims(bin_dir):
+    os.makedirs(bin_dir)
+    shims = {'docker': DOCKER_SHIM}
+    for name in ['git', 'cp']:
+        shims[name] = PASSTHROUGH_SHIM.format(name=name, real=shutil.which(name))
+    for name, text in shims.items():
+        with open(bin_dir + '/' + name, 'w') as file:
+            file.write(text)
+        os.chmod(bin_dir + '/' + name, 0o755)
+
+
+def make_source(path, size_mb, seed):
+    "size_mb of files in a small tree, a quarter of them read-only like generated or vendored files"
+    rng = random.Random(seed)
+    for index in range(size_mb * 16):
+        directory = f'{path}/src/dir{index % 8}'
+        os.makedirs(directory, exist_ok=True)
+        with open(f'{directory}/file{index}.c', 'wb') as file:
+            file.write(rng.randbytes(1 << 16))
+        if index % 4 == 0:
+            os.chmod(f'{directory}/file{index}.c', 0o444)
+    with open(path + '/CMakeLists.txt', 'w') as file:
+        file.write('project(app)\n')
+
+
+def git(args, cwd):
+    # fixed dates, so that the commits and the bytes copied are the same on every run
+    env = dict(os.environ, GIT_AUTHOR_DATE='2022-01-01T00:00:00Z', GIT_COMMITTER_DATE='2022-01-01T00:00:00Z')
+    subprocess.run(['git'] + args, cwd=cwd, env=env, check=True, capture_output=True)
+
+
+def make_manifests(workspace, manifests, distros, size_mb, source):
+    paths = list()
+    for index in range(manifests):
+        src = f'{workspace}/sources/app{index}'
+        make_source(src, size_mb, index)
+        if source == 'git':
+            git(['init', '--quiet'], src)
+            git(['add', '.'], src)
+            git(['-c', 'user.name=bench', '-c', 'user.email=b@e.nch', 'commit', '--quiet', '-m', 'app'], src)
+            git(['tag', 'v1'], src)
+            description = {'type': 'git', 'url': src, 'tag': 'v1'}
+        else:
+            description = {'type': 'dir', 'path': src}
+        manifest = {'distro': DISTROS[:distros],
+                    'app': {'source': description, 'build': {'type': 'cmake'}},
+                    'pkg': {'package': f'app{index}', 'version': '1.0', 'release': 0, 'summary': 'app',
+                            'description': 'app', 'maintainer': 'bench <b@e.nch>'}}
+        paths.append(f'{workspace}/app{index}.yaml')
+        with open(paths[-1], 'w') as file:
+            json.dump(manifest, file)
+    return paths
+
+
+def run_mdpack(workspace, paths, env, jobs):
+    "one mdpack run, returns its metrics"
+    calls_log = env['MDP_BENCH_STATE'] + '/calls.log'
+    if os.path.exists(calls_log):
+        os.remove(calls_log)
+    command = [sys.executable, ROOT + '/mdpack.py'] + paths + [
+        '--docker', 'cli', '--stats', '-j', str(jobs), '--cache-dir', workspace + '/cache',
+        '--log-dir', workspace + '/logs']
+    start = time.perf_counter()
+    with open(workspace + '/mdpack.out', 'w') as out:
+        process = subprocess.Popen(command, cwd=workspace, env=env, stdout=out, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    with open(workspace + '/mdpack.out') as out:
+        output = out.read()
+    if os.waitstatus_to_exitcode(status) != 0:
+        sys.exit('mdpack failed:\n' + output[-4000:])
+    with open(calls_log) as log:
+        calls = [line.split(' ', 1)[0] for line in log]
+    copied = re.search(r'sources: (\d+) bytes copied', output)
+    return {'wall_seconds': round(wall, 3), 'spawns': len(calls), 'docker_calls': calls.count('docker'),
+            'git_calls': calls.count('git'), 'bytes_copied': int(copied.group(1)) if copied else 0,
+            'peak_rss_kb': usage.ru_maxrss}
+
+
+def scenario(manifests, distros, size_mb, source, args):
+    "cold then warm run of a scenario in a new workspace"
+    with tempfile.TemporaryDirectory(prefix='mdp-bench-') as workspace:
+        # the distro defaults and scripts are looked up relatively to the current directory
+        os.symlink(ROOT + '/mdpack', workspace + '/mdpack')
+        write_shims(workspace + '/bin')
+        os.makedirs(workspace + '/state')
+        paths = make_manifests(workspace, manifests, distros, size_mb, source)
+        env = dict(os.environ, PATH=workspace + '/bin:' + os.environ['PATH'], MDP_BENCH_STATE=workspace + '/state',
+                   MDP_BENCH_DOCKER_LATENCY=str(args.docker_latency), MDP_BENCH_GIT_LATENCY=str(args.git_latency))
+        env.pop('DOCKER_HOST', None)
+        return {'cold': run_mdpack(workspace, paths, env, args.jobs),
+                'warm': run_mdpack(workspace, paths, env, args.jobs)}
+
+
+def compare(results, baseline, tolerance):
+    "the regressions of results against baseline, the counts must not grow, the times and memory within tolerance"
+    regressions = list()
+    for name, phases in results.items():
+        for phase, metrics in phases.items():
+            base = baseline.get(name, dict()).get(phase)
+            if base is None:
+                continue
+            for metric in METRICS:
+                value, reference = metrics[metric], base.get(metric)
+                if reference is None:
+                    continue
+                if metric in ('wall_seconds', 'peak_rss_kb'):
+                    # a small absolute slack so that the very short runs don't flap
+                    slack = 0.05 if metric == 'wall_seconds' else 1024
+                    regressed = value > reference * (1 + tolerance) + slack
+                else:
+                    regressed = value > reference
+                if regressed:
+                    regressions.append(f'{name} {phase} {metric}: {reference} -> {value}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--manifests', type=str, default='1,4', help='numbers of manifests')
+    parser.add_argument('--distros', type=str, default='1,3', help='numbers of distro versions per manifest')
+    parser.add_argument('--sizes', type=str, default='1,8', help='source sizes in MB')
+    parser.add_argument('--sources', type=str, default='dir,git', help='source types')
+    parser.add_argument('--jobs', type=int, default=4, help='mdpack -j')
+    parser.add_argument('--docker-latency', type=float, default=0.0, help='seconds added to every docker call')
+    parser.add_argument('--git-latency', type=float, default=0.0, help='seconds added to every git clone and fetch')
+    parser.add_argument('--json', type=str, help='save the results in this file')
+    parser.add_argument('--baseline', type=str, help='compare the results with this file')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results in the --baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative increase of the wall time and the peak RSS, default is 0.25')
+    args = parser.parse_args()
+
+    results = dict()
+    print(f'{"scenario":<26}{"phase":<6}' + ''.join(f'{metric:>14}' for metric in METRICS))
+    for source in args.sources.split(','):
+        for manifests in (int(value) for value in args.manifests.split(',')):
+            for distros in (int(value) for value in args.distros.split(',')):
+                for size_mb in (int(value) for value in args.sizes.split(',')):
+                    name = f'{source}-{manifests}m-{distros}d-{size_mb}mb'
+                    results[name] = scenario(manifests, distros, size_mb, source, args)
+                    for phase, metrics in results[name].items():
+                        print(f'{name:<26}{phase:<6}' + ''.join(f'{metrics[metric]:>14}' for metric in METRICS))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=1)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1)
+    elif args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+        print('no regression against ' + args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
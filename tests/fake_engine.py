@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""Fake Docker Engine API server on a unix socket
+
+Serves the subset of the Engine API used by mdpack (ping, info, image build/inspect/remove, container
+create/start/logs/wait/remove, archive copies, exec) without running anything: images are only remembered with
+their labels, and the containers simulate the mdpack scripts (the package file is written in /app by the pkg stage,
+holding the hash of the sources in /app/src).
+/app is the bind mounted directory, else a directory of the container filled by the archive copies.
+The connections and requests count are printed when it's stopped, to check that the connections are reused, with
+the tags of the images built, to check where the targets of --hosts were placed.
+
+usage: tests/fake_engine.py /tmp/docker.sock [cores]
+       DOCKER_HOST=unix:///tmp/docker.sock ./mdpack.py --docker api manifest.yaml
+       ./mdpack.py --hosts /tmp/docker1.sock,/tmp/docker2.sock manifest.yaml
+"""
+
+import sys
+import os
+import re
+import io
+import json
+import signal
+import asyncio
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import urllib.parse
+
+images = dict()
+containers = dict()
+execs = dict()
+stats = {'connections': 0, 'requests': 0, 'builds': []}
+info = {'NCPU': 4, 'MemTotal': 8 << 30}
+# the filesystems of the containers
+root = tempfile.mkdtemp(prefix='fake-engine-')
+
+
+def frame(data, stream=1):
+    "a frame of the multiplexed stream of a container without tty"
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+
+def app_dir(container, path='/app'):
+    "the host directory of path in the container, a bind mount or a directory under /app"
+    for bind in container['binds']:
+        host, _, target = bind.partition(':')
+        if target.split(':')[0] == path:
+            return host
+    if path != '/app':
+        return app_dir(container) + path[len('/app'):]
+    return container['root'] + '/app'
+
+
+def sources_digest(container):
+    "the hash of the files of /app/src, so that a package tells which sources it was built from"
+    digest = hashlib.sha256()
+    src = app_dir(container, '/app/src')
+    for path, dirs, files in sorted(os.walk(src)):
+        dirs.sort()
+        for name in sorted(files):
+            with open(os.path.join(path, name), 'rb') as file:
+                digest.update(name.encode() + b'\0' + file.read())
+    return digest.hexdigest()
+
+
+def simulate(container, command):
+    "what the mdpack scripts would do in the container, returns its output and exit status"
+    script = ' '.join(command)
+    if command[:1] == ['find']:
+        return frame(b'\0'.join([b'/', b'/usr', b'/usr/bin', b'/etc']) + b'\0'), 0
+    app = app_dir(container)
+    if not os.path.exists(app + '/env.sh'):
+        return frame(b'ran\n'), 0
+    with open(app + '/env.sh') as env:
+        match = re.search(r'PKG_FILENAME=(\S+)', env.read())
+    if 'build.sh' in script or 'whole_process.sh' in script:
+        os.makedirs(app + '/install/usr/bin', exist_ok=True)
+        with open(app + '/install/usr/bin/app', 'w') as file:
+            file.write('app\n')
+    if match and ('pkg.sh' in script or ('whole_process.sh' in script and os.path.exists(app + '/pkg.sh'))):
+        with open(app + '/' + match.group(1), 'w') as file:
+            file.write('pkg ' + sources_digest(container) + '\n')
+    return frame(b'+ ' + script.encode() + b'\n') + frame(b'done\n', 2), 0
+
+
+def handle(method, path, query, body):
+    "returns status, json or bytes body, and whether the body is streamed in chunks"
+    path = re.sub(r'^/v[0-9.]+', '', path)
+    if path == '/_ping':
+        return 200, b'OK', False
+    if path == '/info':
+        return 200, info, False
+
+    if match := re.fullmatch(r'/images/(.+)/json', path):
+        image = images.get(urllib.parse.unquote(match.group(1)))
+        return (200, image, False) if image else (404, {'message': 'No such image'}, False)
+    if match := re.fullmatch(r'/images/(.+)', path):
+        return (200, [], False) if images.pop(urllib.parse.unquote(match.group(1)), None) else (404, {}, False)
+    if path == '/build':
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            names = tar.getnames()
+        if not any(name.endswith('Dockerfile') for name in names):
+            return 200, b'{"error": "Cannot locate specified Dockerfile"}\n', True
+        labels = json.loads(query.get('labels', '{}'))
+        tag = query['t']
+        stats['builds'].append(tag)
+        images[tag] = {'Id': 'sha256:' + hashlib.sha256(body + tag.encode()).hexdigest(), 'Size': len(body),
+                       'Config': {'Labels': labels}}
+        return 200, b''.join(json.dumps({'stream': f'Step {i}/{len(names)} : {name}\n'}).encode() + b'\n'
+                             for i, name in enumerate(names)) + b'{"stream": "Successfully built\\n"}\n', True
+
+    if path == '/containers/create':
+        config = json.loads(body)
+        if config['Image'] not in images and ':' not in config['Image']:
+            return 404, {'message': 'No such image: ' + config['Image']}, False
+        name = query.get('name') or hashlib.sha256(body).hexdigest()[:12]
+        if name in containers:
+            return 409, {'message': 'Conflict'}, False
+        containers[name] = {'command': config['Cmd'], 'binds': config['HostConfig']['Binds'], 'status': None,
+                            'root': os.path.join(root, name)}
+        os.makedirs(containers[name]['root'])
+        return 201, {'Id': name, 'Warnings': []}, False
+    if match := re.fullmatch(r'/containers/([^/]+)/archive', path):
+        container = containers.get(match.group(1))
+        if container is None:
+            return 404, {'message': 'No such container'}, False
+        target = container['root'] + query['path']
+        if method == 'PUT':
+            with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                tar.extractall(target)
+            return 200, b'', False
+        if not os.path.exists(target):
+            return 404, {'message': 'Could not find the file ' + query['path']}, False
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.add(target, arcname=os.path.basename(target))
+        return 200, archive.getvalue(), False
+    if match := re.fullmatch(r'/containers/([^/]+)/start', path):
+        container = containers.get(match.group(1))
+        if container is None:
+            return 404, {'message': 'No such container'}, False
+        container['output'], container['status'] = simulate(container, container['command'])
+        return 204, b'', False
+    if match := re.fullmatch(r'/containers/([^/]+)/logs', path):
+        container = containers.get(match.group(1))
+        return (200, container['output'], True) if container else (404, {}, False)
+    if match := re.fullmatch(r'/containers/([^/]+)/wait', path):
+        container = containers.get(match.group(1))
+        return (200, {'StatusCode': container['status']}, False) if container else (404, {}, False)
+    if match := re.fullmatch(r'/containers/([^/]+)/exec', path):
+        if match.group(1) not in containers:
+            return 404, {'message': 'No such container'}, False
+        exec_id = hashlib.sha256(body + str(len(execs)).encode()).hexdigest()
+        execs[exec_id] = {'container': match.group(1), 'command': json.loads(body)['Cmd']}
+        return 201, {'Id': exec_id}, False
+    if match := re.fullmatch(r'/exec/([^/]+)/start', path):
+        run = execs[match.group(1)]
+        output, run['status'] = simulate(containers[run['container']], run['command'])
+        return 200, output, None
+    if match := re.fullmatch(r'/exec/([^/]+)/json', path):
+        return 200, {'ExitCode': execs[match.group(1)]['status'], 'Running': False}, False
+    if match := re.fullmatch(r'/containers/([^/]+)', path):
+        container = containers.pop(match.group(1), None)
+        if container is None:
+            return 404, {}, False
+        shutil.rmtree(container['root'], ignore_errors=True)
+        return 204, b'', False
+    return 404, {'message': 'not implemented in the fake engine: ' + method + ' ' + path}, False
+
+
+async def serve_connection(reader, writer):
+    stats['connections'] += 1
+    try:
+        while request_line := await reader.readline():
+            method, target, _ = request_line.decode().split(' ', 2)
+            headers = dict()
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            stats['requests'] += 1
+            url = urllib.parse.urlsplit(target)
+            status, data, chunked = handle(method, url.path, dict(urllib.parse.parse_qsl(url.query)), body)
+            if not isinstance(data, bytes):
+                data = json.dumps(data).encode()
+            head = f'HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n'
+            if chunked is None:
+                # raw stream, like exec start, the connection is closed at its end
+                writer.write(head.encode() + b'Content-Type: application/vnd.docker.raw-stream\r\n\r\n' + data)
+                await writer.drain()
+                break
+            if chunked:
+                writer.write(head.encode() + b'Transfer-Encoding: chunked\r\n\r\n')
+                for start in range(0, len(data), 7):
+                    part = data[start:start + 7]
+                    writer.write(f'{len(part):x}\r\n'.encode() + part + b'\r\n')
+                writer.write(b'0\r\n\r\n')
+            else:
+                writer.write(head.encode() + f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+            await writer.drain()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        writer.close()
+
+
+async def main(socket_path):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = await asyncio.start_unix_server(serve_connection, socket_path)
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+    async with server:
+        await stop.wait()
+    os.remove(socket_path)
+    shutil.rmtree(root, ignore_errors=True)
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        info['NCPU'] = int(sys.argv[2])
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else '/tmp/docker.sock'))
@@ -0,0 +1,100 @@
+"""Run mdpack.py offline against tests/fake_engine.py, for the tests of the docker API, --hosts and mdpack serve
+
+A Workspace is a temporary directory holding a symlink to the mdpack scripts, a dir source, the manifests and the
+mdpack cache. FakeEngine starts tests/fake_engine.py on a socket of the workspace and gives its connections and
+requests count, and the images it built, once stopped.
+"""
+
+import sys
+import os
+import json
+import hashlib
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for(path, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'{path} not created')
+        time.sleep(0.05)
+
+
+def sources_digest(src):
+    "the hash of the sources of a package built by the fake engine, computed like tests/fake_engine.py does"
+    digest = hashlib.sha256()
+    for path, dirs, files in sorted(os.walk(src)):
+        dirs.sort()
+        for name in sorted(files):
+            with open(os.path.join(path, name), 'rb') as file:
+                digest.update(name.encode() + b'\0' + file.read())
+    return digest.hexdigest()
+
+
+class Workspace:
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='mdp-test-')
+        # the distro defaults and scripts are looked up relatively to the current directory
+        os.symlink(ROOT + '/mdpack', self.path + '/mdpack')
+        self.write('src/main.c', 'int main() { return 0; }\n')
+        self.write('src/CMakeLists.txt', 'project(app)\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def write(self, name, text):
+        os.makedirs(os.path.dirname(os.path.join(self.path, name)), exist_ok=True)
+        with open(os.path.join(self.path, name), 'w') as file:
+            file.write(text)
+
+    def manifest(self, name, package='hello', distros=('ubuntu:22.04',), source='src'):
+        "write the manifest name of a dir source package, returns its path"
+        manifest = {'distro': list(distros),
+                    'app': {'source': {'type': 'dir', 'path': os.path.join(self.path, source)},
+                            'build': {'type': 'cmake'}},
+                    'pkg': {'package': package, 'version': '1.0', 'release': 0, 'summary': 'test',
+                            'description': 'test package', 'maintainer': 'test <t@e.st>'}}
+        self.write(name, json.dumps(manifest))
+        return os.path.join(self.path, name)
+
+    def mdpack(self, args, cwd=None, env=None, timeout=120):
+        "run mdpack.py with its cache in the workspace, returns the completed process, its output in stdout"
+        return subprocess.run(self.command(args), cwd=cwd or self.path, env=env, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, text=True, timeout=timeout)
+
+    def command(self, args):
+        # the serve, submit and history commands come first
+        command = args[:1] if args[:1] in (['serve'], ['submit'], ['history']) else []
+        return [sys.executable, ROOT + '/mdpack.py'] + command + ['--cache-dir', self.path + '/cache'] \
+            + args[len(command):]
+
+
+class FakeEngine:
+    def __init__(self, socket_path, cores=4):
+        self.socket_path = socket_path
+        self.process = subprocess.Popen([sys.executable, ROOT + '/tests/fake_engine.py', socket_path, str(cores)],
+                                        stdout=subprocess.PIPE, text=True)
+        wait_for(socket_path)
+        self.stats = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        "stop the engine, returns its connections and requests count and the tags of the images it built"
+        if self.stats is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.stats = json.loads(self.process.communicate(timeout=20)[0].strip().splitlines()[-1])
+        return self.stats
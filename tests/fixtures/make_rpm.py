@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Write the rpm fixture of tests/test_repository_index.py, without rpmbuild
+
+The package has a lead, a signature header holding only the archive size, a main header and a 7 bytes payload:
+hello 1.0-0 x86_64, the files /usr/share/hello (dir), /usr/bin/hello and /usr/sbin/hellod, three requirements
+(one rpmlib() and one of the install scripts) and a changelog entry.
+
+usage: tests/fixtures/make_rpm.py tests/fixtures/hello-1.0-0.x86_64.rpm
+"""
+
+import sys
+import struct
+
+INT16, INT32, STRING, STRING_ARRAY, I18NSTRING = 3, 4, 6, 8, 9
+
+
+def header(entries):
+    "an rpm header of (tag, type, value) entries"
+    index = b''
+    store = b''
+    for tag, kind, value in entries:
+        if kind == INT32:
+            store += b'\0' * (-len(store) % 4)
+            data, count = b''.join(struct.pack('>I', item) for item in value), len(value)
+        elif kind == INT16:
+            store += b'\0' * (-len(store) % 2)
+            data, count = b''.join(struct.pack('>H', item) for item in value), len(value)
+        elif kind == STRING:
+            data, count = value.encode() + b'\0', 1
+        else:
+            data, count = b''.join(item.encode() + b'\0' for item in value), len(value)
+        index += struct.pack('>IIII', tag, kind, len(store), count)
+        store += data
+    return b'\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('>II', len(entries), len(store)) + index + store
+
+
+def main(path):
+    lead = b'\xed\xab\xee\xdb' + b'\0' * 92
+    signature = header([(1007, INT32, [12345])])
+    # the main header starts on an 8 bytes boundary
+    signature += b'\0' * (-len(signature) % 8)
+    main_header = header([
+        (1000, STRING, 'hello'), (1001, STRING, '1.0'), (1002, STRING, '0'),
+        (1004, I18NSTRING, ['hi & <bye>']), (1005, I18NSTRING, ['hello desc']), (1006, INT32, [1700000000]),
+        (1007, STRING, 'builder'), (1009, INT32, [4096]), (1014, STRING, 'MIT'), (1015, STRING, 'me <m@e>'),
+        (1016, I18NSTRING, ['Unspecified']), (1022, STRING, 'x86_64'),
+        (1030, INT16, [0o40755, 0o100755, 0o100755]), (1044, STRING, 'hello-1.0-0.src.rpm'),
+        (1047, STRING_ARRAY, ['hello', 'hello(x86-64)']), (1112, INT32, [8, 8]),
+        (1113, STRING_ARRAY, ['1.0-0', '1.0-0']),
+        (1049, STRING_ARRAY, ['libc.so.6()(64bit)', 'rpmlib(CompressedFileNames)', '/bin/sh']),
+        (1048, INT32, [0, 16777226, 1024]), (1050, STRING_ARRAY, ['', '3.0.4-1', '']),
+        (1116, INT32, [0, 1, 2]), (1117, STRING_ARRAY, ['hello', 'hello', 'hellod']),
+        (1118, STRING_ARRAY, ['/usr/share/', '/usr/bin/', '/usr/sbin/']),
+        (1080, INT32, [1690000000]), (1081, STRING_ARRAY, ['me <m@e> - 1.0-0']), (1082, STRING_ARRAY, ['- first'])])
+    with open(path, 'wb') as file:
+        file.write(lead + signature + main_header + b'payload')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""--docker api and --hosts, offline against tests/fake_engine.py
+
+The fake engine sends its streamed responses in chunks of 7 bytes, so that the multiplexed frames of the container
+logs span several chunks.
+
+usage: tests/test_docker_api.py (from the repository root), or python -m pytest tests/test_docker_api.py
+"""
+
+import sys
+import os
+import glob
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mdpack  # noqa: E402
+from fake_run import Workspace, FakeEngine, sources_digest  # noqa: E402
+
+NORMAL = '\033[0;37;40m'
+RED = '\033[1;31;40m'
+GREEN = '\033[1;32;40m'
+
+
+def frame(data, stream=1):
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+
+def test_stream_demux():
+    stream = frame(b'+ make\n') + frame(b'warning\n', 2) + frame(b'') + frame(b'x' * 300) + frame(b'done\n', 2)
+    for size in [1, 3, 7, 8, 9, len(stream)]:
+        stdout, stderr = list(), list()
+        demux = mdpack.StreamDemux(stdout.append, stderr.append)
+        for start in range(0, len(stream), size):
+            demux.feed(stream[start:start + size])
+        assert b''.join(stdout) == b'+ make\n' + b'x' * 300, f'chunks of {size}: {stdout}'
+        assert b''.join(stderr) == b'warning\ndone\n', f'chunks of {size}: {stderr}'
+        assert demux.buffer == b'', f'chunks of {size}'
+
+
+def test_api_run():
+    with Workspace() as workspace, FakeEngine(workspace.path + '/docker.sock') as engine:
+        manifest = workspace.manifest('app.yaml')
+        run = workspace.mdpack([manifest, '--docker', 'api'],
+                               env=dict(os.environ, DOCKER_HOST='unix://' + workspace.path + '/docker.sock'))
+        stats = engine.stop()
+        assert run.returncode == 0 and ' passed ' in run.stdout, run.stdout
+        # the images, build, test and cleanup requests all go through the pooled connection
+        assert stats['connections'] == 1 and stats['requests'] > 10, stats
+        with open(workspace.path + '/ubuntu-22.04-hello-1.0-0.amd64.deb') as file:
+            assert file.read() == f'pkg {sources_digest(workspace.path + "/src")}\n'
+        # the stdout and stderr frames of the containers, and the build messages, are split into lines
+        with open(workspace.path + '/mdpack-logs/mdp-ubuntu-22.04-hello.log') as file:
+            log = file.read()
+        assert '\n+ /bin/bash -x /app/whole_process.sh\ndone\n' in log, log
+        assert '\n+ /bin/bash -x /app/test.sh\ndone\n' in log, log
+        with open(workspace.path + '/mdpack-logs/images/mdp-ubuntu-22.04.log') as file:
+            log = file.read()
+        assert '\nStep 1/3 : ./Dockerfile\n' in log and '\nSuccessfully built\n' in log, log
+
+
+def test_hosts_placement():
+    with Workspace() as workspace, FakeEngine(workspace.path + '/a.sock') as first, \
+            FakeEngine(workspace.path + '/b.sock') as second:
+        manifest = workspace.manifest('app.yaml', distros=('ubuntu:22.04', 'ubuntu:20.04'))
+        hosts = f'{workspace.path}/a.sock=1,{workspace.path}/b.sock=1'
+        for attempt in range(2):
+            run = workspace.mdpack([manifest, '--hosts', hosts, '-j', '2'])
+            assert run.returncode == 0 and run.stdout.count(' passed ') == 2, run.stdout
+            for distro in ['ubuntu-22.04', 'ubuntu-20.04']:
+                with open(f'{workspace.path}/{distro}-hello-1.0-0.amd64.deb') as file:
+                    assert file.read() == f'pkg {sources_digest(workspace.path + "/src")}\n', distro
+            for path in glob.glob(workspace.path + '/*.deb'):
+                os.remove(path)
+        # one target per host, and the second run goes back to the host having its images instead of building them
+        builds = [set(first.stop()['builds']), set(second.stop()['builds'])]
+        assert all(builds) and not builds[0] & builds[1], builds
+        assert len(first.stats['builds']) == len(builds[0]) and len(second.stats['builds']) == len(builds[1]), \
+            (first.stats, second.stats)
+
+
+def main():
+    failed = 0
+    for test in [test_stream_demux, test_api_run, test_hosts_placement]:
+        print(test.__name__ + ' .. ', end='')
+        sys.stdout.flush()
+        try:
+            test()
+            print(GREEN + 'ok' + NORMAL)
+        except AssertionError as exc:
+            print(RED + 'failed' + NORMAL + f' {exc}')
+            failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""RepositoryIndex: the apt and yum metadata, checked against the known content of small packages
+
+tests/fixtures/hello-1.0-0.x86_64.rpm is a 900 bytes package written by tests/fixtures/make_rpm.py: a signature
+header holding only the archive size (12345), a main header (name hello, three files, three requirements,
+a changelog) and a 7 bytes payload. The deb package is written by DebWriter.
+
+usage: tests/test_repository_index.py (from the repository root), or python -m pytest tests/test_repository_index.py
+"""
+
+import sys
+import os
+import gzip
+import lzma
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import types
+import xml.etree.ElementTree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import mdpack  # noqa: E402
+
+NORMAL = '\033[0;37;40m'
+RED = '\033[1;31;40m'
+GREEN = '\033[1;32;40m'
+
+FIXTURE = os.path.join(ROOT, 'tests', 'fixtures', 'hello-1.0-0.x86_64.rpm')
+COMMON = '{http://linux.duke.edu/metadata/common}'
+RPM = '{http://linux.duke.edu/metadata/rpm}'
+FILELISTS = '{http://linux.duke.edu/metadata/filelists}'
+REPO = '{http://linux.duke.edu/metadata/repo}'
+
+
+def test_rpm_header():
+    with open(FIXTURE, 'rb') as rpm:
+        signature, end = mdpack.RepositoryIndex.rpm_header(rpm, 96)
+        assert signature == {1007: [12345]}
+        assert end == 132
+        # the main header starts on the next 8 bytes boundary
+        header, end = mdpack.RepositoryIndex.rpm_header(rpm, 136)
+    assert end == 893
+    assert header[1000] == 'hello'
+    assert header[1001] == '1.0'
+    assert header[1049] == ['libc.so.6()(64bit)', 'rpmlib(CompressedFileNames)', '/bin/sh']
+    assert header[1117] == ['hello', 'hello', 'hellod']
+    assert header[1118] == ['/usr/share/', '/usr/bin/', '/usr/sbin/']
+
+
+def test_rpm_metadata():
+    rpm = mdpack.RepositoryIndex.rpm_metadata(FIXTURE)
+    assert (rpm['name'], rpm['epoch'], rpm['version'], rpm['release'], rpm['arch']) == \
+        ('hello', '0', '1.0', '0', 'x86_64')
+    # the rpmlib() requirements are left out, like createrepo does
+    assert rpm['requires'] == [{'name': 'libc.so.6()(64bit)'}, {'name': '/bin/sh', 'pre': '1'}]
+    assert rpm['provides'][0] == {'name': 'hello', 'flags': 'EQ', 'epoch': '0', 'ver': '1.0', 'rel': '0'}
+    assert rpm['files'] == [['/usr/share/hello', 'dir'], ['/usr/bin/hello', ''], ['/usr/sbin/hellod', '']]
+    assert rpm['header_range'] == [136, 893]
+    assert (rpm['installed'], rpm['archive']) == (4096, 12345)
+    assert rpm['changelogs'] == [[1690000000, 'me <m@e> - 1.0-0', '- first']]
+
+
+def test_write_rpm():
+    output_dir = tempfile.mkdtemp()
+    try:
+        shutil.copy(FIXTURE, output_dir)
+        mdpack.RepositoryIndex.update(output_dir, [('fedora', '35', os.path.basename(FIXTURE))])
+        repodata = os.path.join(output_dir, 'repo', 'fedora-35', 'repodata')
+        repomd = xml.etree.ElementTree.parse(repodata + '/repomd.xml').getroot()
+        locations = {data.get('type'): data.find(REPO + 'location').get('href')
+                     for data in repomd.findall(REPO + 'data')}
+        assert set(locations) == {'primary', 'filelists', 'other'}
+        with gzip.open(os.path.join(output_dir, 'repo', 'fedora-35', locations['primary'])) as file:
+            primary = xml.etree.ElementTree.parse(file).getroot()
+        assert primary.get('packages') == '1'
+        package = primary.find(COMMON + 'package')
+        assert package.find(COMMON + 'name').text == 'hello'
+        assert package.find(COMMON + 'version').attrib == {'epoch': '0', 'ver': '1.0', 'rel': '0'}
+        assert package.find(COMMON + 'summary').text == 'hi & <bye>'
+        assert package.find(COMMON + 'location').get('href') == 'hello-1.0-0.x86_64.rpm'
+        assert package.find(COMMON + 'size').attrib == {'package': '900', 'installed': '4096', 'archive': '12345'}
+        rpm_format = package.find(COMMON + 'format')
+        assert rpm_format.find(RPM + 'header-range').attrib == {'start': '136', 'end': '893'}
+        assert [entry.get('name') for entry in rpm_format.find(RPM + 'requires')] == ['libc.so.6()(64bit)', '/bin/sh']
+        # primary only lists the files in a bin/ or sbin/ directory, /etc/ or /usr/lib/sendmail
+        assert [file.text for file in rpm_format.findall(COMMON + 'file')] == ['/usr/bin/hello', '/usr/sbin/hellod']
+        with gzip.open(os.path.join(output_dir, 'repo', 'fedora-35', locations['filelists'])) as file:
+            filelists = xml.etree.ElementTree.parse(file).getroot()
+        files = filelists.find(FILELISTS + 'package').findall(FILELISTS + 'file')
+        assert [(file.text, file.get('type')) for file in files] == \
+            [('/usr/share/hello', 'dir'), ('/usr/bin/hello', None), ('/usr/sbin/hellod', None)]
+    finally:
+        shutil.rmtree(output_dir)
+
+
+CONTROL = 'Package: hello\nVersion: 1.0-0\nArchitecture: amd64\nMaintainer: me <m@e>\nDescription: hi\n hello desc\n'
+
+
+def write_deb(root):
+    "a deb package of /usr/bin/hello written by DebWriter in root/out, returns its name"
+    os.makedirs(root + '/install/DEBIAN')
+    os.makedirs(root + '/install/usr/bin')
+    os.makedirs(root + '/out')
+    with open(root + '/install/DEBIAN/control', 'w') as file:
+        file.write(CONTROL)
+    with open(root + '/install/usr/bin/hello', 'w') as file:
+        file.write('hello\n')
+    assert mdpack.DebWriter.write(root + '/install', root + '/out/ubuntu-22.04-hello-1.0-0.amd64.deb')
+    return 'ubuntu-22.04-hello-1.0-0.amd64.deb'
+
+
+def stanza(text):
+    "the fields of a Packages stanza, the continuation lines joined to their field"
+    fields = dict()
+    for line in text.strip('\n').split('\n'):
+        if line.startswith(' '):
+            fields[name] += '\n' + line
+        else:
+            name, _, value = line.partition(': ')
+            fields[name] = value
+    return fields
+
+
+def test_deb_control():
+    root = tempfile.mkdtemp()
+    try:
+        name = write_deb(root)
+        assert mdpack.RepositoryIndex.deb_control(root + '/out/' + name) == CONTROL
+    finally:
+        shutil.rmtree(root)
+
+
+def test_write_deb():
+    root = tempfile.mkdtemp()
+    try:
+        name = write_deb(root)
+        mdpack.RepositoryIndex.update(root + '/out', [('ubuntu', '22.04', name)])
+        repo_dir = root + '/out/repo/ubuntu-22.04'
+        with open(repo_dir + '/' + name, 'rb') as file:
+            package = file.read()
+        with open(repo_dir + '/Packages', 'rb') as file:
+            packages = file.read()
+        # one stanza, ended by a blank line like dpkg-scanpackages
+        assert packages.endswith(b'\n\n') and packages.count(b'\n\n') == 1
+        assert stanza(packages.decode()) == dict(stanza(CONTROL), **{
+            'Filename': './' + name, 'Size': str(len(package)), 'MD5sum': hashlib.md5(package).hexdigest(),
+            'SHA1': hashlib.sha1(package).hexdigest(), 'SHA256': hashlib.sha256(package).hexdigest()})
+        with open(repo_dir + '/Packages.xz', 'rb') as file:
+            assert lzma.decompress(file.read()) == packages
+        with open(repo_dir + '/Release') as file:
+            release = file.read()
+        assert '\nArchitectures: amd64\n' in release
+        assert f' {hashlib.sha256(packages).hexdigest()} {len(packages)} Packages\n' in release
+        assert f' {hashlib.md5(packages).hexdigest()} {len(packages)} Packages\n' in release
+        # the same fields as dpkg-scanpackages, which orders them differently
+        if shutil.which('dpkg-scanpackages'):
+            scanned = subprocess.run(['dpkg-scanpackages', '.', '/dev/null'], cwd=repo_dir, capture_output=True,
+                                     text=True, check=True).stdout
+            assert stanza(scanned) == stanza(packages.decode())
+    finally:
+        shutil.rmtree(root)
+
+
+def test_manifest_control():
+    # the control file written from the manifest, the Maintainer on its own line after the long description
+    root = tempfile.mkdtemp()
+    try:
+        pkg = types.SimpleNamespace(type='deb', package='hello', version='1.0-0', arch='amd64', summary='hi',
+                                    description='hello desc\n\nsecond paragraph', maintainer='me <m@e>')
+        mdpack.PkgConfBuilder(types.SimpleNamespace(pkg=pkg), root)
+        with open(root + '/install/DEBIAN/control') as file:
+            control = file.read()
+        assert control == 'Package: hello\nVersion: 1.0-0\nArchitecture: amd64\n' \
+            'Description: hi\n hello desc\n .\n second paragraph\nMaintainer: me <m@e>\n', control
+        assert mdpack.DebWriter.write(root + '/install', root + '/hello.deb')
+        assert stanza(mdpack.RepositoryIndex.deb_control(root + '/hello.deb'))['Maintainer'] == 'me <m@e>'
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    failed = 0
+    for test in [test_rpm_header, test_rpm_metadata, test_write_rpm, test_deb_control, test_write_deb,
+                 test_manifest_control]:
+        print(test.__name__ + ' .. ', end='')
+        sys.stdout.flush()
+        try:
+            test()
+            print(GREEN + 'ok' + NORMAL)
+        except AssertionError as exc:
+            print(RED + 'failed' + NORMAL + f' {exc}')
+            failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""SafeTar: the archives of the sources and the docker copies are extracted inside their destination
+
+Checked with the checks made by hand before Python 3.11.4, and with the tarfile 'data' filter when it exists.
+
+usage: tests/test_safe_tar.py (from the repository root), or python -m pytest tests/test_safe_tar.py
+"""
+
+import sys
+import os
+import io
+import shutil
+import tarfile
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mdpack  # noqa: E402
+
+NORMAL = '\033[0;37;40m'
+RED = '\033[1;31;40m'
+GREEN = '\033[1;32;40m'
+
+
+def archive(members):
+    "a tar stream of (name, linkname) members, a regular file when linkname is None, else a symlink"
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for name, linkname in members:
+            info = tarfile.TarInfo(name)
+            if linkname is None:
+                info.size = 5
+                tar.addfile(info, io.BytesIO(b'evil\n'))
+            else:
+                info.type = tarfile.SYMTYPE
+                info.linkname = linkname
+                tar.addfile(info)
+    data.seek(0)
+    return data
+
+
+def extract(members, filtered):
+    "extract the members into <tmp>/dest, returns whether it was accepted and the files written in <tmp>"
+    root = tempfile.mkdtemp()
+    filtered_before = mdpack.SafeTar.filtered
+    mdpack.SafeTar.filtered = filtered
+    try:
+        os.makedirs(root + '/dest')
+        try:
+            # streamed, like the archives of the sources and docker cp
+            with tarfile.open(fileobj=archive(members), mode='r|') as tar:
+                mdpack.SafeTar.extractall(tar, root + '/dest')
+            accepted = True
+        except tarfile.TarError:
+            accepted = False
+        return accepted, sorted(os.path.relpath(os.path.join(path, name), root)
+                                for path, dirs, files in os.walk(root) for name in files)
+    finally:
+        mdpack.SafeTar.filtered = filtered_before
+        shutil.rmtree(root)
+
+
+def modes():
+    return [False, True] if hasattr(tarfile, 'data_filter') else [False]
+
+
+def test_regular_archive():
+    for filtered in modes():
+        assert extract([('app/main.c', None), ('app/link.c', 'main.c')], filtered) == \
+            (True, ['dest/app/link.c', 'dest/app/main.c']), f'filtered={filtered}'
+
+
+def test_outside_names():
+    for filtered in modes():
+        for members in [[('../evil', None)], [('/tmp/evil', None)], [('app/../../evil', None)],
+                        [('link', '../..')], [('link', '/etc')]]:
+            # the 'data' filter strips the leading / of the absolute names, the checks by hand reject them
+            accepted, files = extract(members, filtered)
+            assert all(file.startswith('dest/') for file in files), f'filtered={filtered} {members} {files}'
+            assert not accepted or members[0][0].startswith('/'), f'filtered={filtered} {members}'
+
+
+def test_symlink_chain():
+    # a -> . then a/b -> .. points b to the parent of dest, the names alone don't show it
+    for filtered in modes():
+        accepted, files = extract([('a', '.'), ('a/b', '..'), ('b/evil', None)], filtered)
+        assert not accepted, f'filtered={filtered}'
+        assert files == [], f'filtered={filtered} {files}'
+
+
+def main():
+    failed = 0
+    for test in [test_regular_archive, test_outside_names, test_symlink_chain]:
+        print(test.__name__ + ' .. ', end='')
+        sys.stdout.flush()
+        try:
+            test()
+            print(GREEN + 'ok' + NORMAL)
+        except AssertionError as exc:
+            print(RED + 'failed' + NORMAL + f' {exc}')
+            failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""mdpack serve and mdpack submit, offline against tests/fake_engine.py
+
+usage: tests/test_serve.py (from the repository root), or python -m pytest tests/test_serve.py
+"""
+
+import sys
+import os
+import signal
+import subprocess
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_run import Workspace, FakeEngine, wait_for, sources_digest  # noqa: E402
+
+NORMAL = '\033[0;37;40m'
+RED = '\033[1;31;40m'
+GREEN = '\033[1;32;40m'
+
+
+@contextlib.contextmanager
+def server(workspace, jobs=1):
+    "an mdpack serve of the workspace driving a fake engine, yields its socket path"
+    engine_socket, socket_path = workspace.path + '/docker.sock', workspace.path + '/serve.sock'
+    with FakeEngine(engine_socket):
+        env = dict(os.environ, DOCKER_HOST='unix://' + engine_socket)
+        process = subprocess.Popen(workspace.command(['serve', '--docker', 'api', '--socket', socket_path,
+                                                      '-j', str(jobs)]),
+                                   cwd=workspace.path, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for(socket_path)
+            yield socket_path
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=20)
+
+
+def test_source_change_between_submissions():
+    with Workspace() as workspace, server(workspace) as socket_path:
+        manifest = workspace.manifest('app.yaml')
+        os.makedirs(workspace.path + '/out')
+        first = workspace.mdpack(['submit', manifest, '--socket', socket_path], cwd=workspace.path + '/out')
+        assert first.returncode == 0, first.stdout
+        assert 'passed (cached)' not in first.stdout, first.stdout
+        # the daemon must see the new source, not the fingerprint of the first submission
+        workspace.write('src/main.c', 'int main() { return 1; }\n')
+        second = workspace.mdpack(['submit', manifest, '--socket', socket_path], cwd=workspace.path + '/out')
+        assert second.returncode == 0, second.stdout
+        assert 'artifact cache hit' not in second.stdout and 'passed (cached)' not in second.stdout, second.stdout
+        # unchanged, the package comes from the artifact store
+        third = workspace.mdpack(['submit', manifest, '--socket', socket_path], cwd=workspace.path + '/out')
+        assert 'passed (cached)' in third.stdout, third.stdout
+
+
+def test_same_package_from_two_manifests():
+    # two manifests building the same package, version and distro from different sources, submitted at once
+    with Workspace() as workspace, server(workspace, jobs=2) as socket_path:
+        workspace.write('other/main.c', 'int main() { return 2; }\n')
+        submissions = list()
+        for name, source in [('a', 'src'), ('b', 'other')]:
+            os.makedirs(f'{workspace.path}/out-{name}')
+            manifest = workspace.manifest(f'{name}.yaml', source=source)
+            submissions.append(subprocess.Popen(workspace.command(['submit', manifest, '--socket', socket_path]),
+                                                cwd=f'{workspace.path}/out-{name}', stdout=subprocess.PIPE,
+                                                stderr=subprocess.STDOUT, text=True))
+        for submission in submissions:
+            output = submission.communicate(timeout=120)[0]
+            assert submission.returncode == 0, output
+        for name, source in [('a', 'src'), ('b', 'other')]:
+            with open(f'{workspace.path}/out-{name}/ubuntu-22.04-hello-1.0-0.amd64.deb') as file:
+                assert file.read() == f'pkg {sources_digest(workspace.path + "/" + source)}\n', name
+        # nothing is delivered through the directory of the daemon
+        assert not os.path.exists(workspace.path + '/ubuntu-22.04-hello-1.0-0.amd64.deb')
+
+
+def main():
+    failed = 0
+    for test in [test_source_change_between_submissions, test_same_package_from_two_manifests]:
+        print(test.__name__ + ' .. ', end='')
+        sys.stdout.flush()
+        try:
+            test()
+            print(GREEN + 'ok' + NORMAL)
+        except AssertionError as exc:
+            print(RED + 'failed' + NORMAL + f' {exc}')
+            failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())